@@ -1,9 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response, session
+from flask import Flask, abort, render_template, request, redirect, url_for, flash, make_response, session, jsonify, Response, stream_with_context, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import secure_filename
 from datetime import datetime, date, time, timedelta
-import os, secrets, requests
+import os, sys, secrets, requests, random, threading, sqlite3, hashlib, json, queue
+from itertools import groupby
+from collections import OrderedDict, defaultdict
+from select import select as select_fds
+from itsdangerous import URLSafeSerializer, BadSignature
+from time import sleep, monotonic, perf_counter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import click
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType, SimpleNamespace
+from sqlalchemy import event, func, inspect, text, select, update, delete, or_, literal
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session as OrmSession, joinedload
+try:
+    import redis  # optional: shared view cache across gunicorn workers
+except ImportError:
+    redis = None
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL","sqlite:///gym.db")
@@ -11,6 +30,8 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.secret_key = os.environ.get("SECRET_KEY","dev-secret")
 BRAND_NAME = os.environ.get("BRAND_NAME","Pgym 2.0")
 DEFAULT_LOCATION = os.environ.get("DEFAULT_LOCATION","Pgym 2.0")
+# Personal slots live only in the compiled schedule until someone books them
+VIRTUAL_SLOTS = os.environ.get("VIRTUAL_PERSONAL_SLOTS","0") == "1"
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -31,7 +52,9 @@ class Member(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     email = db.Column(db.String(120), nullable=True, unique=True)
-    phone = db.Column(db.String(50), nullable=True)
+    phone = db.Column(db.String(50), nullable=True, index=True)
+    calendar_token = db.Column(db.String(64), nullable=True, unique=True, index=True)  # secret of the webcal feed
+    __table_args__ = (db.Index("ix_member_name", "name"),)
 
 class ClassSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,6 +66,18 @@ class ClassSession(db.Model):
     capacity = db.Column(db.Integer, nullable=False, default=2)
     location = db.Column(db.String(120), nullable=True)
     bookings = db.relationship("Booking", backref="class_session", cascade="all, delete-orphan")
+    # kept in step with Booking by conditional UPDATEs; `flask reconcile-counts` repairs drift
+    booked_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)  # insert time, for the rollups
+    @property
+    def spots_left(self): return self.capacity - self.booked_count
+    __table_args__ = (
+        db.Index("uq_class_slot", "title", "date", "start_time", "end_time", "location", unique=True),
+        db.Index("ix_class_session_date_start", "date", "start_time"),
+        # partial index over sessions with spots left: next-available search never touches full ones
+        db.Index("ix_class_session_open", "title", "date", "start_time",
+                 sqlite_where=text("booked_count < capacity"), postgresql_where=text("booked_count < capacity")),
+    )
 
 class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -50,7 +85,11 @@ class Booking(db.Model):
     class_id = db.Column(db.Integer, db.ForeignKey("class_session.id"), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     member = db.relationship("Member")
-    __table_args__ = (db.UniqueConstraint("member_id", "class_id", name="uq_member_class"),)
+    __table_args__ = (
+        db.UniqueConstraint("member_id", "class_id", name="uq_member_class"),
+        db.Index("ix_booking_member_created", "member_id", "created_at"),
+        db.Index("ix_booking_class", "class_id"),
+    )
 
 class AppSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,6 +97,8 @@ class AppSettings(db.Model):
     personal_capacity = db.Column(db.Integer, default=int(os.environ.get("DEFAULT_PERSONAL_CAPACITY","2")))
     personal_duration_min = db.Column(db.Integer, default=int(os.environ.get("DEFAULT_PERSONAL_DURATION_MIN","60")))
     personal_coach = db.Column(db.String(120), default=os.environ.get("PERSONAL_COACH",""))
+    schedule_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # bumped on every write
 
 class Package(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -67,6 +108,29 @@ class Package(db.Model):
     activated_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=True)
     member = db.relationship("Member")
+    __table_args__ = (db.Index("ix_package_member_activated", "member_id", "activated_at"),)
+
+class PackageLedger(db.Model):
+    # append-only entry movements: +entries on a new package, -1 per booking, -remaining on expiry
+    id = db.Column(db.Integer, primary_key=True)
+    member_id = db.Column(db.Integer, db.ForeignKey("member.id"), nullable=False)
+    package_id = db.Column(db.Integer, db.ForeignKey("package.id"), nullable=True)
+    booking_id = db.Column(db.Integer, db.ForeignKey("booking.id"), nullable=True)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)  # credit, booking, expiry, opening
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index("ix_ledger_member_created", "member_id", "created_at"),
+        # one credit/opening row per package: a rebuild racing another process cannot open it twice
+        db.Index("uq_ledger_package_opening", "package_id", unique=True,
+                 sqlite_where=text("reason IN ('credit', 'opening')"), postgresql_where=text("reason IN ('credit', 'opening')")),
+    )
+
+class MemberBalance(db.Model):
+    # materialized sum of PackageLedger.delta per member
+    member_id = db.Column(db.Integer, db.ForeignKey("member.id"), primary_key=True)
+    balance = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class PackagePurchase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -76,20 +140,89 @@ class PackagePurchase(db.Model):
     purchased_at = db.Column(db.DateTime, default=datetime.utcnow)
     activated_at = db.Column(db.DateTime, default=datetime.utcnow)
     expires_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)  # purchased_at can be backdated
     member = db.relationship("Member")
 
+class RevenueRollup(db.Model):
+    # packages sold and revenue per day and size, from PackagePurchase
+    day = db.Column(db.Date, primary_key=True)
+    package_size = db.Column(db.Integer, primary_key=True)
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12,2), nullable=False, default=0)
+
+class UsageRollup(db.Model):
+    # sessions, seats and bookings per day and slot; coach "" when unassigned
+    day = db.Column(db.Date, primary_key=True)
+    title = db.Column(db.String(120), primary_key=True)
+    coach = db.Column(db.String(120), primary_key=True)
+    start_time = db.Column(db.Time, primary_key=True)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    capacity = db.Column(db.Integer, nullable=False, default=0)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupWatermark(db.Model):
+    # highest source id already folded into the rollups, per source
+    name = db.Column(db.String(40), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
 class MagicToken(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     member_id = db.Column(db.Integer, db.ForeignKey("member.id"), nullable=False)
     token = db.Column(db.String(64), unique=True, nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     used = db.Column(db.Boolean, default=False)
     member = db.relationship("Member")
 
+class SlotWatermark(db.Model):
+    # last day already materialized into ClassSession rows, per location and slot type
+    id = db.Column(db.Integer, primary_key=True)
+    location = db.Column(db.String(120), nullable=False)
+    slot_type = db.Column(db.String(120), nullable=False)
+    materialized_until = db.Column(db.Date, nullable=False)
+    __table_args__ = (db.UniqueConstraint("location", "slot_type", name="uq_slot_watermark"),)
+
+class ScheduleBlock(db.Model):
+    # weekly template for the generated Personal slots; slot_minutes None = AppSettings.personal_duration_min
+    id = db.Column(db.Integer, primary_key=True)
+    location = db.Column(db.String(120), nullable=False, default=DEFAULT_LOCATION)
+    coach = db.Column(db.String(120), nullable=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = lunedì
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    slot_minutes = db.Column(db.Integer, nullable=True)
+
+class OutboxMessage(db.Model):
+    # outgoing WhatsApp messages, drained by `flask outbox-worker`
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(50), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index("ix_outbox_status_next", "status", "next_attempt_at"),)
+
+class WeekVersion(db.Model):
+    # bumped whenever a ClassSession or Booking of the week changes; keys the week-view caches
+    week_start = db.Column(db.Date, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class AvailabilityEvent(db.Model):
+    # spots-left changes for the database pub/sub backend; rows are pruned after a few minutes
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(20), nullable=False)  # week start, ISO date
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    if "user" not in g:
+        g.user = db.session.get(User, int(user_id))
+    return g.user
 
 # --- Helpers ---
 def parse_date(s): return datetime.strptime(s, "%Y-%m-%d").date()
@@ -98,56 +231,906 @@ def daterange(start_date, end_date):
     for n in range((end_date - start_date).days + 1):
         yield start_date + timedelta(n)
 
+_settings_cache = {"version": None, "snapshot": None}
+
 def ensure_settings():
-    s = AppSettings.query.first()
-    if not s:
-        s = AppSettings()
-        db.session.add(s)
+    # read-only snapshot of AppSettings: one version query per request (per call outside requests),
+    # the row itself is reloaded only when another write bumped AppSettings.version
+    if has_request_context() and "settings" in g:
+        return g.settings
+    version = db.session.query(AppSettings.version).order_by(AppSettings.id).limit(1).scalar()
+    if version is None:
+        db.session.add(AppSettings())
         db.session.commit()
-    return s
-
-def slot_ranges_for_personal(day: date):
-    wd = day.weekday()
-    slots = []
-    def add_block(start_h, end_h):
-        cur_dt = datetime.combine(day, time(hour=start_h))
-        dur = ensure_settings().personal_duration_min
-        while cur_dt.time() < time(hour=end_h):
-            end_dt = cur_dt + timedelta(minutes=dur)
-            if end_dt.time() > time(hour=end_h): break
-            slots.append((cur_dt.time(), end_dt.time()))
-            cur_dt = end_dt
-    if wd in (0,2,4):  # Mon, Wed, Fri
-        add_block(8,20)
-    elif wd in (1,3):  # Tue, Thu
-        add_block(6,20)
-    elif wd == 5:      # Sat
-        add_block(9,11); add_block(16,19)
-    return slots
-
-def upsert_personal_slots():
+        version = db.session.query(AppSettings.version).order_by(AppSettings.id).limit(1).scalar()
+    if _settings_cache["version"] != version:
+        row = AppSettings.query.order_by(AppSettings.id).first()
+        _settings_cache.update(version=row.version, snapshot=SimpleNamespace(
+            **{c.name: getattr(row, c.name) for c in AppSettings.__table__.columns}
+        ))
+    if has_request_context():
+        g.settings = _settings_cache["snapshot"]
+    return _settings_cache["snapshot"]
+
+@event.listens_for(OrmSession, "before_flush")
+def _bump_settings_version(session, flush_context, instances):
+    for o in session.dirty:
+        if isinstance(o, AppSettings) and session.is_modified(o):
+            o.version = (o.version or 0) + 1
+
+def insert_ignoring(model):
+    # INSERT ... ON CONFLICT DO NOTHING (sqlite/postgres), relies on the model's unique indexes
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model.__table__).on_conflict_do_nothing()
+
+def insert_ignore(model, rows, session=None):
+    # one batched insert of rows, skipping those that already exist
+    if not rows:
+        return 0
+    (session or db.session).execute(insert_ignoring(model), rows)
+    return len(rows)
+
+def job_lock(name):
+    # one holder at a time until the transaction ends: an advisory lock on Postgres; on SQLite an empty
+    # UPDATE takes the database write lock, so nothing read after it can change before the commit
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+    else:
+        db.session.execute(text("UPDATE app_settings SET version = version WHERE 0 = 1"))
+
+def week_of(d):
+    return d - timedelta(days=d.weekday())
+
+def bump_week_versions(days, session=None):
+    # for writes that bypass the ORM (bulk inserts/updates); ORM flushes are caught by _bump_week_versions.
+    # Only queued here: _apply_week_bumps writes them once the caller's transaction has committed
+    session = session or db.session
+    weeks = {week_of(d) for d in days if d}
+    if weeks:
+        session.info.setdefault("week_bumps", set()).update(weeks)
+
+def write_week_bumps(conn, weeks):
+    weeks = sorted(weeks)
+    insert_ignore(WeekVersion, [dict(week_start=w, version=0, updated_at=datetime.utcnow()) for w in weeks], conn)
+    t = WeekVersion.__table__
+    conn.execute(update(t).where(t.c.week_start.in_(weeks)).values(version=t.c.version + 1, updated_at=datetime.utcnow()))
+
+@event.listens_for(OrmSession, "after_commit")
+def _apply_week_bumps(session):
+    # a short transaction of its own after the data commit: concurrent bookings of one week never queue
+    # on the week_version row lock. Readers that saw the old version only cache new data under the old key
+    weeks = session.info.pop("week_bumps", None)
+    if not weeks:
+        return
+    try:
+        with db.engine.begin() as conn:
+            write_week_bumps(conn, weeks)
+    except Exception as e:
+        # the data is committed either way; the week's caches catch up with its next write
+        app.logger.warning("week version bump failed: %s", e)
+
+@event.listens_for(OrmSession, "after_rollback")
+def _drop_week_bumps(session):
+    session.info.pop("week_bumps", None)
+
+def week_stamp(start):
+    # (version, updated_at) of the week; (0, None) until something in it is written
+    row = db.session.query(WeekVersion.version, WeekVersion.updated_at).filter_by(week_start=start).first()
+    return (row[0], row[1]) if row else (0, None)
+
+def migrate_db():
+    # create_all() skips existing tables: add columns and indexes declared after the table was created
+    insp = inspect(db.engine)
+    added = set()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(db.engine.dialect)}"
+                if col.server_default is not None:
+                    ddl += f" DEFAULT {col.server_default.arg}"
+                conn.execute(text(ddl))
+                added.add(f"{table.name}.{col.name}")
+    for table in db.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(db.engine, checkfirst=True)
+    if "class_session.booked_count" in added:
+        # the column arrives as 0 everywhere: count the existing bookings before serving any
+        fix_booked_counts(booked_count_drift())
+    if db.session.execute(select(untracked_packages().exists())).scalar():
+        # packages sold before the ledger: open their entries before any balance is read
+        rebuild_balances(only_if_untracked=True)
+
+# weekday, start hour, end hour: used until a ScheduleBlock template is stored
+DEFAULT_WEEKLY_BLOCKS = [
+    (0, 8, 20), (2, 8, 20), (4, 8, 20),  # Mon, Wed, Fri
+    (1, 6, 20), (3, 6, 20),              # Tue, Thu
+    (5, 9, 11), (5, 16, 19),             # Sat
+]
+
+_schedule_cache = {}  # location -> ((schedule_version, duration), compiled table)
+
+def compile_schedule(blocks, dur):
+    table = {wd: [] for wd in range(7)}
+    for wd, start, end, coach, slot_min in blocks:
+        step = slot_min or dur
+        cur = start.hour*60 + start.minute
+        stop = end.hour*60 + end.minute
+        while step > 0 and cur + step <= stop:
+            nxt = cur + step
+            table[wd].append((time(cur//60, cur%60), time(nxt//60, nxt%60), coach))
+            cur = nxt
+    compiled = {}
+    for wd, slots in table.items():
+        # a slot is identified by its time: of overlapping slots (older templates) the first wins
+        kept = []
+        for slot in sorted(slots, key=lambda s: (s[0], s[1])):
+            if not kept or slot[0] >= kept[-1][1]:
+                kept.append(slot)
+        compiled[wd] = tuple(kept)
+    return MappingProxyType(compiled)
+
+def overlapping_blocks(blocks):
+    # (start, end) pairs of a weekday that overlap: a slot is identified by its time, not its coach,
+    # so two coaches cannot share an hour
+    ordered = sorted(blocks)
+    return [(a, b) for a, b in zip(ordered, ordered[1:]) if b[0] < a[1]]
+
+def compiled_schedule(settings=None, location=DEFAULT_LOCATION):
+    settings = settings or ensure_settings()
+    key = (settings.schedule_version, settings.personal_duration_min)
+    cached = _schedule_cache.get(location)
+    if cached and cached[0] == key:
+        return cached[1]
+    rows = ScheduleBlock.query.filter_by(location=location).all()
+    if rows:
+        blocks = [(b.weekday, b.start_time, b.end_time, b.coach, b.slot_minutes) for b in rows]
+    else:
+        blocks = [(wd, time(sh), time(eh), None, None) for wd, sh, eh in DEFAULT_WEEKLY_BLOCKS]
+    table = compile_schedule(blocks, settings.personal_duration_min)
+    _schedule_cache[location] = (key, table)
+    return table
+
+def slot_ranges_for_personal(day: date, settings=None, location=DEFAULT_LOCATION):
+    # (start, end, coach) tuples for the day, straight from the compiled weekly table
+    return compiled_schedule(settings, location)[day.weekday()]
+
+@event.listens_for(OrmSession, "before_flush")
+def _bump_schedule_version(session, flush_context, instances):
+    changed = [o for o in (*session.new, *session.dirty, *session.deleted) if isinstance(o, ScheduleBlock)]
+    if not changed:
+        return
+    # other processes see the new version on their next settings read and recompile
+    t = AppSettings.__table__
+    session.execute(update(t).values(schedule_version=t.c.schedule_version + 1, version=t.c.version + 1))
+    # days past the watermark were generated from the old template
+    locations = {o.location or DEFAULT_LOCATION for o in changed}
+    session.execute(delete(SlotWatermark.__table__).where(SlotWatermark.__table__.c.location.in_(locations)))
+
+def upsert_personal_slots(full=False):
+    if VIRTUAL_SLOTS:
+        return 0
     settings = ensure_settings()
     today = date.today()
     end_day = today + timedelta(weeks=settings.weeks_ahead)
-    for d in daterange(today, end_day):
-        for start, end in slot_ranges_for_personal(d):
-            exists = ClassSession.query.filter_by(
-                title="Personal", date=d, start_time=start, end_time=end, location=DEFAULT_LOCATION
-            ).first()
-            if not exists:
-                cs = ClassSession(
+    wm = SlotWatermark.query.filter_by(location=DEFAULT_LOCATION, slot_type="Personal").first()
+    start_day = today
+    if wm and not full:
+        # only the days past the watermark are missing
+        start_day = max(today, wm.materialized_until + timedelta(days=1))
+    if start_day > end_day:
+        return 0
+    # one range query for what exists, set diff in memory, one batched insert for the rest
+    existing = {(r.date, r.start_time, r.end_time): r for r in db.session.query(
+        ClassSession.id, ClassSession.date, ClassSession.start_time, ClassSession.end_time, ClassSession.booked_count
+    ).filter(
+        ClassSession.title=="Personal", ClassSession.location==DEFAULT_LOCATION,
+        ClassSession.date>=start_day, ClassSession.date<=end_day
+    )}
+    missing, wanted = [], set()
+    for d in daterange(start_day, end_day):
+        for start, end, coach in slot_ranges_for_personal(d, settings):
+            wanted.add((d, start, end))
+            if (d, start, end) not in existing:
+                missing.append(dict(
                     title="Personal",
-                    coach=settings.personal_coach or None,
+                    coach=coach or settings.personal_coach or None,
                     date=d, start_time=start, end_time=end,
                     capacity=settings.personal_capacity,
                     location=DEFAULT_LOCATION
-                )
-                db.session.add(cs)
+                ))
+    created = insert_ignore(ClassSession, missing)
+    # slots the template no longer has: drop them unless someone already booked one
+    stale = [r for k, r in existing.items() if k not in wanted and not r.booked_count]
+    if stale:
+        t = ClassSession.__table__
+        deleted = db.session.execute(delete(t).where(
+            t.c.id.in_([r.id for r in stale]), t.c.booked_count == 0,
+            ~select(Booking.id).where(Booking.class_id == t.c.id).exists(),
+        ).returning(t.c.id, t.c.date, t.c.title, t.c.coach, t.c.start_time, t.c.capacity)).all()
+        unroll_sessions(deleted)
+    bump_week_versions([r["date"] for r in missing] + [r.date for r in stale])
+    if not wm:
+        wm = SlotWatermark(location=DEFAULT_LOCATION, slot_type="Personal", materialized_until=end_day)
+        db.session.add(wm)
+    elif wm.materialized_until < end_day:
+        wm.materialized_until = end_day
     db.session.commit()
+    return created
+
+class VirtualSlot:
+    # a Personal slot of the compiled schedule that has no ClassSession row yet
+    id = None
+    title = "Personal"
+    location = DEFAULT_LOCATION
+    bookings = ()
+    booked_count = 0
+    @property
+    def spots_left(self): return self.capacity
+    def __init__(self, day, start_time, end_time, coach, capacity):
+        self.date = day
+        self.start_time = start_time
+        self.end_time = end_time
+        self.coach = coach
+        self.capacity = capacity
+
+def virtual_slot(day, start_time, settings=None):
+    settings = settings or ensure_settings()
+    today = date.today()
+    if not today <= day <= today + timedelta(weeks=settings.weeks_ahead):
+        return None
+    for start, end, coach in slot_ranges_for_personal(day, settings):
+        if start == start_time:
+            return VirtualSlot(day, start, end, coach or settings.personal_coach or None, settings.personal_capacity)
+    return None
+
+def materialize_slot(slot):
+    # first booking of a virtual slot: insert its row (idempotent under races) in the caller's transaction
+    insert_ignore(ClassSession, [dict(
+        title=slot.title, coach=slot.coach, date=slot.date, start_time=slot.start_time,
+        end_time=slot.end_time, capacity=slot.capacity, location=slot.location
+    )])
+    bump_week_versions([slot.date])
+    return ClassSession.query.filter_by(
+        title=slot.title, date=slot.date, start_time=slot.start_time, end_time=slot.end_time, location=slot.location
+    ).one()
+
+def sessions_in_range(start, end):
+    # booked_count rides on the row: one query, no bookings loaded
+    return ClassSession.query.filter(ClassSession.date>=start, ClassSession.date<=end)\
+        .order_by(ClassSession.date, ClassSession.start_time).all()
+
+def claim_spot(class_id):
+    # capacity check and increment in one statement: concurrent requests cannot both take the last spot
+    cs = ClassSession.__table__.c
+    res = db.session.execute(
+        update(ClassSession.__table__)
+        .where(cs.id == class_id, cs.booked_count < cs.capacity)
+        .values(booked_count=cs.booked_count + 1)
+    )
+    return res.rowcount == 1
+
+BOOKING_RETRIES = int(os.environ.get("BOOKING_RETRIES","4"))
+
+def find_or_create_member(name, email, phone):
+    # (member, identified): only an exact email match says who is booking, a bare name does not
+    member = None
+    if email: member = Member.query.filter_by(email=email).first()
+    if member: return member, True
+    if name: member = Member.query.filter_by(name=name).first()
+    if member: return member, False
+    member = Member(name=name or "Cliente", email=email or None, phone=phone or None)
+    db.session.add(member); db.session.flush()
+    return member, True
+
+def book_class(class_id, name, email="", phone="", member_id=None):
+    # one transaction per attempt: member, conditional spot claim, booking insert, package entry.
+    # The claim UPDATE takes the row lock (Postgres) / write lock (SQLite), so a lock
+    # timeout or serialization failure rolls everything back and the attempt is retried.
+    # member_id: the member logged in on this session, booking without the form's identity.
+    for attempt in range(BOOKING_RETRIES):
+        try:
+            if member_id:
+                member, identified = db.session.get(Member, member_id), True
+            else:
+                member, identified = find_or_create_member(name, email, phone)
+            if Booking.query.filter_by(member_id=member.id, class_id=class_id).first():
+                db.session.rollback(); return "duplicate"
+            if not claim_spot(class_id):
+                db.session.rollback(); return "full"
+            booking = Booking(member_id=member.id, class_id=class_id)
+            db.session.add(booking); db.session.flush()
+            # entries are spent only for an identified member: typing someone's name must not use theirs
+            if (not identified or consume_entry(member.id, booking.id) is None) and REQUIRE_PACKAGE:
+                db.session.rollback(); return "no_entries"
+            db.session.commit()
+            return "ok"
+        except (IntegrityError, OperationalError):
+            # lost a race (same member twice, new member email) or the database was busy
+            db.session.rollback()
+            if attempt == BOOKING_RETRIES - 1:
+                raise
+            sleep(0.02 * 2**attempt + random.random() * 0.02)
+
+def booked_count_drift():
+    # (class_id, stored, actual) for every session whose counter disagrees with Booking
+    actual = db.session.query(Booking.class_id, func.count(Booking.id).label("n"))\
+        .group_by(Booking.class_id).subquery()
+    n = func.coalesce(actual.c.n, 0)
+    return db.session.query(ClassSession.id, ClassSession.booked_count, n)\
+        .outerjoin(actual, actual.c.class_id == ClassSession.id)\
+        .filter(ClassSession.booked_count != n).all()
+
+def fix_booked_counts(drift):
+    # one bulk UPDATE by primary key for all drifted sessions
+    if drift:
+        db.session.execute(update(ClassSession), [dict(id=c, booked_count=a) for c, _, a in drift])
+        ids = [c for c, _, _ in drift]
+        bump_week_versions([d for (d,) in db.session.query(ClassSession.date).filter(ClassSession.id.in_(ids))])
+        db.session.commit()
+    return len(drift)
+
+def hot_queries():
+    # the lookups every page depends on; `flask check-query-plans` keeps them on an index
+    today = date.today()
+    return {
+        "week sessions": ClassSession.query.filter(ClassSession.date>=today, ClassSession.date<=today+timedelta(days=6))
+            .order_by(ClassSession.date, ClassSession.start_time),
+        "member bookings": Booking.query.filter_by(member_id=1).order_by(Booking.created_at.desc()),
+        "member by phone": Member.query.filter_by(phone="+390000000000"),
+        "member by name": Member.query.filter_by(name="Cliente"),
+        "next available": ClassSession.query.filter(
+            ClassSession.title=="Personal", ClassSession.booked_count < ClassSession.capacity, ClassSession.date>=today
+        ).order_by(ClassSession.date, ClassSession.start_time).limit(5),
+        "latest package": Package.query.filter_by(member_id=1).order_by(Package.activated_at.desc()).limit(1),
+        "magic token": MagicToken.query.filter_by(token="x"),
+        "member calendar feed": Member.query.filter_by(calendar_token="x"),
+    }
+
+def explain(query):
+    compiled = query.statement.compile(db.engine)
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == "sqlite":
+            params = tuple(compiled.params[k] for k in compiled.positiontup)
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params)
+            return [r[-1] for r in rows]
+        # the planner would pick a seq scan on a small table anyway: ask whether an index path exists
+        conn.exec_driver_sql("SET enable_seqscan = off")
+        return [r[0] for r in conn.exec_driver_sql("EXPLAIN " + str(compiled), compiled.params)]
+
+def is_full_scan(plan_line):
+    line = plan_line.strip()
+    if "Seq Scan" in line:
+        return True
+    return line.startswith("SCAN ") and "USING" not in line
+
+def add_virtual_slots(d, items, settings):
+    # merge the day's unmaterialized schedule slots into its ClassSession rows, sorted by time
+    today = date.today()
+    if not today <= d <= today + timedelta(weeks=settings.weeks_ahead):
+        return items
+    taken = {(s.start_time, s.end_time) for s in items if s.title == "Personal" and s.location == DEFAULT_LOCATION}
+    for st, en, coach in slot_ranges_for_personal(d, settings):
+        if (st, en) not in taken:
+            items.append(VirtualSlot(d, st, en, coach or settings.personal_coach or None, settings.personal_capacity))
+    items.sort(key=lambda s: s.start_time)
+    return items
+
+def week_days(start):
+    end = start + timedelta(days=6)
+    days = { (start + timedelta(days=i)): [] for i in range(7) }
+    for s in sessions_in_range(start, end):
+        days[s.date].append(s)
+    if VIRTUAL_SLOTS:
+        settings = ensure_settings()
+        for d, items in days.items():
+            add_virtual_slots(d, items, settings)
+    return days
+
+def iter_sessions(start, end):
+    # streams the range in (date, start_time) order without holding it all in memory
+    q = ClassSession.query.filter(ClassSession.date>=start, ClassSession.date<=end)\
+        .order_by(ClassSession.date, ClassSession.start_time).yield_per(500)
+    if not VIRTUAL_SLOTS:
+        yield from q
+        return
+    settings = ensure_settings()
+    groups = groupby(q, key=lambda s: s.date)
+    current = next(groups, None)
+    for d in daterange(start, end):
+        items = []
+        if current and current[0] == d:
+            items = list(current[1])
+            current = next(groups, None)
+        yield from add_virtual_slots(d, items, settings)
+
+@event.listens_for(OrmSession, "before_flush")
+def _bump_week_versions(session, flush_context, instances):
+    days = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, ClassSession):
+            days.add(obj.date)
+            days.update(d for d in inspect(obj).attrs.date.history.deleted if d)
+        elif isinstance(obj, Booking) and obj.class_id:
+            cs = session.get(ClassSession, obj.class_id)
+            if cs:
+                days.add(cs.date)
+    bump_week_versions([d for d in days if d], session)
+
+# --- Live availability pub/sub ---
+# each open stream holds a worker thread: enable only behind threaded/async workers,
+# e.g. gunicorn -k gthread --threads 32 (the default sync worker would serve one visitor at a time).
+# Off, bookings neither collect nor publish events.
+LIVE_AVAILABILITY = os.environ.get("LIVE_AVAILABILITY","0") == "1"
+
+class InProcessPubSub:
+    # topic -> subscriber queues of this process; the other backends feed their events through fanout()
+    def __init__(self):
+        self.topics = defaultdict(set)
+        self.lock = threading.Lock()
+    def subscribe(self, topic):
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            self.topics[topic].add(q)
+        return q
+    def unsubscribe(self, topic, q):
+        with self.lock:
+            self.topics[topic].discard(q)
+            if not self.topics[topic]:
+                del self.topics[topic]
+    def fanout(self, events):
+        for topic, payload in events:
+            with self.lock:
+                subscribers = list(self.topics.get(topic, ()))
+            for q in subscribers:
+                try:
+                    q.put_nowait(payload)
+                except queue.Full:
+                    pass  # a stalled client misses deltas; it reloads on reconnect
+    def publish(self, events):
+        self.fanout(events)
+
+class DatabasePubSub(InProcessPubSub):
+    # events go through the availability_event table, polled by one thread per process
+    def __init__(self, interval=1.0, keep_minutes=10):
+        super().__init__()
+        self.interval = interval
+        self.keep_minutes = keep_minutes
+        self.poller = None
+    def publish(self, events):
+        # the publisher prunes too (indexed on created_at): the table stays small with no subscriber
+        t = AvailabilityEvent.__table__
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            conn.execute(t.insert(), [dict(topic=tp, payload=json.dumps(p), created_at=now) for tp, p in events])
+            conn.execute(delete(t).where(t.c.created_at < now - timedelta(minutes=self.keep_minutes)))
+    def subscribe(self, topic):
+        with self.lock:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll, daemon=True)
+                self.poller.start()
+        return super().subscribe(topic)
+    def _poll(self):
+        t = AvailabilityEvent.__table__
+        with app.app_context():
+            with db.engine.connect() as conn:
+                last = conn.execute(select(func.coalesce(func.max(t.c.id), 0))).scalar()
+            while True:
+                sleep(self.interval)
+                try:
+                    with db.engine.begin() as conn:
+                        rows = conn.execute(select(t.c.id, t.c.topic, t.c.payload).where(t.c.id > last).order_by(t.c.id)).all()
+                except Exception as e:
+                    app.logger.warning("pubsub poll error: %s", e)
+                    continue
+                if rows:
+                    last = rows[-1].id
+                    self.fanout([(r.topic, json.loads(r.payload)) for r in rows])
+
+class PostgresPubSub(InProcessPubSub):
+    # NOTIFY on publish; one LISTEN connection per process
+    CHANNEL = "availability"
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+    def publish(self, events):
+        with db.engine.begin() as conn:
+            for topic, payload in events:
+                conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                             dict(channel=self.CHANNEL, payload=json.dumps([topic, payload])))
+    def subscribe(self, topic):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self._listen, daemon=True)
+                self.listener.start()
+        return super().subscribe(topic)
+    def _listen(self):
+        with app.app_context():
+            while True:
+                try:
+                    raw = db.engine.raw_connection()
+                    pg = raw.driver_connection
+                    pg.autocommit = True
+                    pg.cursor().execute(f"LISTEN {self.CHANNEL}")
+                    while True:
+                        if select_fds([pg], [], [], 30) == ([], [], []):
+                            continue
+                        pg.poll()
+                        while pg.notifies:
+                            topic, payload = json.loads(pg.notifies.pop(0).payload)
+                            self.fanout([(topic, payload)])
+                except Exception as e:
+                    app.logger.warning("pubsub listen error: %s", e)
+                    sleep(5)
+
+def make_pubsub():
+    if not LIVE_AVAILABILITY:
+        return InProcessPubSub()  # nothing publishes: no table writes, no listener threads
+    backend = os.environ.get("PUBSUB_BACKEND") or ("postgres" if db.engine.dialect.name == "postgresql" else "database")
+    return {"memory": InProcessPubSub, "database": DatabasePubSub, "postgres": PostgresPubSub}[backend]()
+
+with app.app_context():
+    pubsub = make_pubsub()
+
+@event.listens_for(OrmSession, "before_flush")
+def _collect_availability_events(session, flush_context, instances):
+    # the spot claim already ran in this transaction, so booked_count is the post-commit value
+    if not LIVE_AVAILABILITY:
+        return
+    class_ids = {o.class_id for o in (*session.new, *session.deleted) if isinstance(o, Booking) and o.class_id}
+    if not class_ids:
+        return
+    t = ClassSession.__table__
+    rows = session.execute(select(t.c.id, t.c.title, t.c.date, t.c.start_time, t.c.capacity, t.c.booked_count)
+                           .where(t.c.id.in_(class_ids))).all()
+    session.info.setdefault("availability_events", {}).update({
+        r.id: (week_of(r.date).isoformat(), {
+            "id": r.id, "slot": f"{r.title}@{r.date.isoformat()}T{r.start_time.strftime('%H:%M')}",
+            "spots_left": r.capacity - r.booked_count,
+        }) for r in rows
+    })
+
+@event.listens_for(OrmSession, "after_commit")
+def _publish_availability_events(session):
+    events = session.info.pop("availability_events", None)
+    if events:
+        try:
+            pubsub.publish(list(events.values()))
+        except Exception as e:
+            app.logger.warning("pubsub publish error: %s", e)
+
+@event.listens_for(OrmSession, "after_rollback")
+def _drop_availability_events(session):
+    session.info.pop("availability_events", None)
+
+class ViewCache:
+    # rendered fragments: in-process LRU in front of an optional shared backend (Redis)
+    def __init__(self, maxsize=256, shared=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.local = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+    def get_or_render(self, key, render):
+        if self.maxsize <= 0:
+            return render()
+        with self.lock:
+            if key in self.local:
+                self.local.move_to_end(key)
+                self.hits += 1
+                return self.local[key]
+        value = self.shared.get(key) if self.shared else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            value = render()
+            if self.shared:
+                self.shared.set(key, value)
+        with self.lock:
+            self.local[key] = value
+            while len(self.local) > self.maxsize:
+                self.local.popitem(last=False)
+        return value
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.local),
+                    "hit_ratio": round(self.hits / total, 4) if total else None}
+
+class RedisCache:
+    def __init__(self, url, ttl=3600):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+    def get(self, key):
+        try:
+            value = self.client.get(key)
+        except redis.RedisError:
+            return None
+        return value.decode() if value is not None else None
+    def set(self, key, value):
+        try:
+            self.client.set(key, value, ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+week_cache = ViewCache(
+    maxsize=int(os.environ.get("WEEK_CACHE_SIZE","256")),
+    shared=RedisCache(os.environ["REDIS_URL"]) if redis and os.environ.get("REDIS_URL") else None,
+)
+
+def virtual_fingerprint():
+    # what virtual slots depend on besides the rows: the day and the schedule settings
+    if not VIRTUAL_SLOTS:
+        return ""
+    st = ensure_settings()
+    return f":{date.today().isoformat()}:{st.schedule_version}:{st.personal_duration_min}:{st.weeks_ahead}:{st.personal_capacity}:{st.personal_coach}"
+
+def week_cache_key(view, start, stamp=None):
+    # the week version changes with every write to the week, so old entries are simply never read again
+    version, _ = stamp or week_stamp(start)
+    return f"{view}:{start.isoformat()}:{version}" + virtual_fingerprint()
+
+def range_stamp(start, end):
+    # (weeks, sum of versions, last update) over the range: any write to it changes the first two
+    t = WeekVersion
+    return tuple(db.session.query(
+        func.count(t.week_start), func.coalesce(func.sum(t.version), 0), func.max(t.updated_at)
+    ).filter(t.week_start>=week_of(start), t.week_start<=end).one())
+
+def render_week(template, start, key=None):
+    return week_cache.get_or_render(
+        key or week_cache_key(template, start),
+        lambda: render_template(template, days=week_days(start)),
+    )
+
+def data_last_modified(updated_at, window_start=None):
+    # window_start: first day of a range the URL derives from today (no explicit week/from), so the
+    # same URL shows another range from that day on; virtual slots drop off the page as days pass
+    floor = max(filter(None, (window_start, date.today() if VIRTUAL_SLOTS else None)), default=None)
+    if not floor:
+        return updated_at
+    midnight = datetime.combine(floor, time())
+    return max(updated_at, midnight) if updated_at else midnight
+
+def conditional_response(validators, last_modified, build, cache_control="no-cache"):
+    # 304 without running `build` when the client's copy is current (If-None-Match / If-Modified-Since)
+    etag = hashlib.sha1(repr(validators).encode()).hexdigest()
+    if last_modified:
+        last_modified = last_modified.replace(microsecond=0)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = make_response("", 304)
+    else:
+        resp = make_response(build())
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
+def conditional_page(validators, last_modified, render):
+    # the navbar depends on the member session, and pending flashes must always be shown
+    if "_flashes" in session:
+        return render()
+    resp = conditional_response((validators, bool(session.get("member_id"))), last_modified, render, "private, no-cache")
+    resp.vary.add("Cookie")
+    return resp
+
+REQUIRE_PACKAGE = os.environ.get("REQUIRE_PACKAGE","0") == "1"  # refuse bookings without entries left
 
 def member_remaining_entries(member_id):
-    pkg = Package.query.filter_by(member_id=member_id).order_by(Package.activated_at.desc()).first()
-    return pkg.remaining if pkg else 0
+    # the balance minus what expired packages still hold until sweep-packages zeroes them:
+    # the same entries consume_entry() would refuse
+    pt = Package.__table__
+    expired = select(func.coalesce(func.sum(pt.c.remaining), 0)).where(
+        pt.c.member_id == member_id, pt.c.remaining > 0, pt.c.expires_at <= datetime.utcnow()).scalar_subquery()
+    return db.session.execute(
+        select(MemberBalance.balance - expired).where(MemberBalance.member_id == member_id)
+    ).scalar() or 0
+
+def apply_ledger(rows, session=None):
+    # append ledger rows and move the materialized balances by the same deltas, in the caller's transaction
+    session = session or db.session
+    if not rows:
+        return
+    now = datetime.utcnow()
+    session.execute(PackageLedger.__table__.insert(), [dict(created_at=now, **r) for r in rows])
+    deltas = defaultdict(int)
+    for r in rows:
+        deltas[r["member_id"]] += r["delta"]
+    insert_ignore(MemberBalance, [dict(member_id=m, balance=0, updated_at=now) for m in deltas], session)
+    t = MemberBalance.__table__
+    for member_id, delta in deltas.items():
+        session.execute(update(t).where(t.c.member_id == member_id).values(balance=t.c.balance + delta, updated_at=now))
+
+@event.listens_for(OrmSession, "after_flush")
+def _credit_new_packages(session, flush_context):
+    apply_ledger([
+        dict(member_id=o.member_id, package_id=o.id, delta=o.remaining, reason="credit")
+        for o in session.new if isinstance(o, Package) and o.remaining
+    ], session)
+
+def consume_entry(member_id, booking_id):
+    # FIFO: the oldest unexpired package with entries left, decremented only if it still has one
+    pt = Package.__table__
+    for _ in range(5):
+        pkg_id = db.session.execute(
+            select(pt.c.id).where(
+                pt.c.member_id == member_id, pt.c.remaining > 0,
+                or_(pt.c.expires_at.is_(None), pt.c.expires_at > datetime.utcnow()),
+            ).order_by(pt.c.activated_at, pt.c.id).limit(1)
+        ).scalar()
+        if pkg_id is None:
+            return None
+        res = db.session.execute(update(pt).where(pt.c.id == pkg_id, pt.c.remaining > 0).values(remaining=pt.c.remaining - 1))
+        if res.rowcount == 1:
+            break
+    else:
+        return None
+    apply_ledger([dict(member_id=member_id, package_id=pkg_id, booking_id=booking_id, delta=-1, reason="booking")])
+    return pkg_id
+
+def expire_packages(batch_size=500):
+    # zero out expired packages with entries left, a batch per transaction, debiting what they still held
+    pt = Package.__table__
+    now = datetime.utcnow()
+    total = 0
+    while True:
+        # what the batch reads stays valid until its commit, so the debits match what is zeroed:
+        # the rows are locked on Postgres, the database write lock is held on SQLite
+        job_lock("pgym.expire_packages")
+        q = select(pt.c.id, pt.c.member_id, pt.c.remaining).where(
+            pt.c.expires_at < now, pt.c.remaining > 0).order_by(pt.c.id).limit(batch_size)
+        if db.engine.dialect.name == "postgresql":
+            q = q.with_for_update()
+        rows = db.session.execute(q).all()
+        if not rows:
+            db.session.rollback()
+            return total
+        db.session.execute(update(pt).where(
+            pt.c.id.in_([r.id for r in rows]), pt.c.expires_at < now, pt.c.remaining > 0).values(remaining=0))
+        apply_ledger([dict(member_id=r.member_id, package_id=r.id, delta=-r.remaining, reason="expiry") for r in rows])
+        db.session.commit()
+        total += len(rows)
+
+def as_date(v):
+    # func.date() comes back as a string on SQLite
+    return parse_date(v) if isinstance(v, str) else v
+
+ROLLUP_LAG_MINUTES = int(os.environ.get("ROLLUP_LAG_MINUTES","10"))
+
+def settled_max_id(model, created_col):
+    # highest id among rows older than the lag. max(id) read now could pass a lower id whose transaction
+    # has not committed yet, and that row would never be folded; a transaction open for longer than the
+    # lag is assumed gone. Rows from before created_at existed (NULL) count as settled.
+    cutoff = datetime.utcnow() - timedelta(minutes=ROLLUP_LAG_MINUTES)
+    return db.session.query(model.id).filter(or_(created_col.is_(None), created_col <= cutoff))\
+        .order_by(model.id.desc()).limit(1).scalar() or 0
+
+def rollup_watermark(name):
+    wm = db.session.get(RollupWatermark, name)
+    if not wm:
+        wm = RollupWatermark(name=name, last_id=0)
+        db.session.add(wm)
+    return wm
+
+def add_to_rollup(model, key_rows):
+    # additive upsert of (key, increments) pairs: create missing keys at zero, then SET col = col + n per key
+    if not key_rows:
+        return
+    t = model.__table__
+    insert_ignore(model, [dict(k, **{c: 0 for c in inc}) for k, inc in key_rows])
+    for key, inc in key_rows:
+        db.session.execute(update(t).where(*[t.c[c] == v for c, v in key.items()])
+                           .values(**{c: t.c[c] + n for c, n in inc.items()}))
+
+def unroll_sessions(rows):
+    # deleted (id, date, title, coach, start_time, capacity) sessions leave UsageRollup if run_rollups
+    # already counted them; none of them had bookings. A rollup running concurrently with the
+    # delete can still count one of them
+    wm = db.session.get(RollupWatermark, "class_session")
+    counted = defaultdict(lambda: [0, 0])
+    for r in rows:
+        if wm and r.id <= wm.last_id:
+            c = counted[(r.date, r.title, r.coach or "", r.start_time)]
+            c[0] += 1; c[1] += r.capacity
+    t = UsageRollup.__table__
+    for (d, title, coach, st), (n, cap) in counted.items():
+        key = [t.c.day == d, t.c.title == title, t.c.coach == coach, t.c.start_time == st]
+        db.session.execute(update(t).where(*key).values(sessions=t.c.sessions - n, capacity=t.c.capacity - cap))
+        db.session.execute(delete(t).where(*key, t.c.sessions <= 0, t.c.booked == 0))
+
+def run_rollups():
+    # fold in only the rows added since the last run, up to the settled id of each source.
+    # Overlapping runs take turns: each reads the watermarks the previous one committed
+    job_lock("pgym.run_rollups")
+    done = {}
+    pp = PackagePurchase
+    wm = rollup_watermark("package_purchase")
+    top = settled_max_id(pp, pp.created_at)
+    rows = db.session.query(func.date(pp.purchased_at), pp.package_size, func.count(pp.id), func.coalesce(func.sum(pp.price), 0))\
+        .filter(pp.id > wm.last_id, pp.id <= top).group_by(func.date(pp.purchased_at), pp.package_size).all()
+    add_to_rollup(RevenueRollup, [(dict(day=as_date(d), package_size=size), dict(sold=n, revenue=rev)) for d, size, n, rev in rows])
+    wm.last_id, done["package_purchase"] = max(wm.last_id, top), len(rows)
+
+    cs = ClassSession
+    wm = rollup_watermark("class_session")
+    top = settled_max_id(cs, cs.created_at)
+    rows = db.session.query(cs.date, cs.title, func.coalesce(cs.coach, ""), cs.start_time, func.count(cs.id), func.sum(cs.capacity))\
+        .filter(cs.id > wm.last_id, cs.id <= top).group_by(cs.date, cs.title, func.coalesce(cs.coach, ""), cs.start_time).all()
+    add_to_rollup(UsageRollup, [(dict(day=d, title=t, coach=c, start_time=st), dict(sessions=n, capacity=cap))
+                                for d, t, c, st, n, cap in rows])
+    wm.last_id, done["class_session"] = max(wm.last_id, top), len(rows)
+
+    wm = rollup_watermark("booking")
+    top = settled_max_id(Booking, Booking.created_at)
+    rows = db.session.query(cs.date, cs.title, func.coalesce(cs.coach, ""), cs.start_time, func.count(Booking.id))\
+        .join(cs, cs.id == Booking.class_id).filter(Booking.id > wm.last_id, Booking.id <= top)\
+        .group_by(cs.date, cs.title, func.coalesce(cs.coach, ""), cs.start_time).all()
+    add_to_rollup(UsageRollup, [(dict(day=d, title=t, coach=c, start_time=st), dict(booked=n))
+                                for d, t, c, st, n in rows])
+    wm.last_id, done["booking"] = max(wm.last_id, top), len(rows)
+    db.session.commit()
+    return done
+
+def rollup_report(start, end):
+    # reads only the rollup tables: O(days in range), whatever the number of bookings
+    revenue = RevenueRollup.query.filter(RevenueRollup.day>=start, RevenueRollup.day<=end).all()
+    usage = UsageRollup.query.filter(UsageRollup.day>=start, UsageRollup.day<=end).all()
+    by_month, by_size = defaultdict(lambda: [0, 0]), defaultdict(int)
+    for r in revenue:
+        m = by_month[r.day.strftime("%Y-%m")]
+        m[0] += r.sold; m[1] += r.revenue or 0
+        by_size[r.package_size] += r.sold
+    by_slot, by_coach = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    for u in usage:
+        for bucket in (by_slot[(u.title, u.start_time)], by_coach[u.coach or "-"]):
+            bucket[0] += u.booked; bucket[1] += u.capacity
+    pct = lambda b, c: round(100 * b / c, 1) if c else None
+    return dict(
+        months=sorted((k, v[0], v[1]) for k, v in by_month.items()),
+        sizes=sorted(by_size.items()),
+        slots=sorted((t, st, b, c, pct(b, c)) for (t, st), (b, c) in by_slot.items()),
+        coaches=sorted((coach, b, c, pct(b, c)) for coach, (b, c) in by_coach.items()),
+    )
+
+def untracked_packages():
+    # packages with no credit/opening row (they predate the ledger), with what they held before the
+    # debits already in the ledger: remaining minus the sum of their rows
+    pt, lt = Package.__table__, PackageLedger.__table__
+    moved = select(func.coalesce(func.sum(lt.c.delta), 0)).where(lt.c.package_id == pt.c.id).scalar_subquery()
+    opened = select(lt.c.id).where(lt.c.package_id == pt.c.id, lt.c.reason.in_(("credit", "opening"))).exists()
+    return select(pt.c.member_id, pt.c.id, (pt.c.remaining - moved).label("delta")).where(~opened, pt.c.remaining != moved)
+
+def rebuild_balances(only_if_untracked=False):
+    # opening ledger rows for packages that predate the ledger, then balances = sum of the ledger.
+    # Every process runs this at startup (migrate_db): they take turns, and a process that finds the
+    # packages already opened by the one before it leaves the balances alone. Bookings wait too
+    # (the SQLite write lock; on Postgres the table lock), so none commits between the sum and the rewrite
+    job_lock("pgym.rebuild_balances")
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("LOCK TABLE member_balance IN SHARE ROW EXCLUSIVE MODE"))
+    if only_if_untracked and not db.session.execute(select(untracked_packages().exists())).scalar():
+        db.session.rollback()
+        return 0
+    now = datetime.utcnow()
+    opening = untracked_packages().add_columns(literal("opening"), literal(now))
+    db.session.execute(insert_ignoring(PackageLedger).from_select(
+        ["member_id", "package_id", "delta", "reason", "created_at"], opening))
+    sums = db.session.query(PackageLedger.member_id, func.sum(PackageLedger.delta)).group_by(PackageLedger.member_id).all()
+    db.session.execute(delete(MemberBalance.__table__))
+    if sums:
+        db.session.execute(MemberBalance.__table__.insert(),
+                           [dict(member_id=m, balance=b or 0, updated_at=now) for m, b in sums])
+    db.session.commit()
+    return len(sums)
 
 def week_bounds(ref: date):
     start = ref - timedelta(days=ref.weekday())
@@ -155,31 +1138,265 @@ def week_bounds(ref: date):
     return start, end
 
 # WhatsApp sender
-def send_whatsapp_text(to_e164: str, body: str) -> bool:
-    token = os.environ.get("WHATSAPP_TOKEN")
-    phone_id = os.environ.get("WHATSAPP_PHONE_ID")
-    if not token or not phone_id or not to_e164:
-        return False
-    url = f"https://graph.facebook.com/v17.0/{phone_id}/messages"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+WHATSAPP_API_BASE = os.environ.get("WHATSAPP_API_BASE","https://graph.facebook.com/v17.0")
+# queue magic links in the outbox instead of calling the Graph API inside the request
+WHATSAPP_OUTBOX = os.environ.get("WHATSAPP_OUTBOX","0") == "1"
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS","6"))
+
+def whatsapp_configured():
+    return bool(os.environ.get("WHATSAPP_TOKEN") and os.environ.get("WHATSAPP_PHONE_ID"))
+
+WHATSAPP_TIMEOUT = (float(os.environ.get("WHATSAPP_CONNECT_TIMEOUT","3")), float(os.environ.get("WHATSAPP_READ_TIMEOUT","10")))
+
+class LatencyHistogram:
+    # cumulative-bucket histogram in seconds, Prometheus style
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    def observe(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.sum += seconds
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    self.counts[i] += 1
+    def snapshot(self):
+        with self.lock:
+            return {"buckets": dict(zip(self.buckets, self.counts)), "count": self.count, "sum": round(self.sum, 6)}
+
+class CircuitOpen(Exception):
+    pass
+
+class CircuitBreaker:
+    # closed -> open after `threshold` consecutive failures; one probe allowed after `reset_seconds`
+    def __init__(self, threshold=5, reset_seconds=30):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                return True
+            return False
+    def record_success(self):
+        with self.lock:
+            self.state, self.failures = "closed", 0
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.state, self.opened_at = "open", monotonic()
+    def snapshot(self):
+        with self.lock:
+            return {"state": self.state, "consecutive_failures": self.failures}
+
+def make_whatsapp_http():
+    # keep-alive pool shared by the web threads and the outbox worker pool. Only a failed connect is
+    # retried (the API never saw the request); a 429/5xx comes straight back, so every upstream
+    # failure reaches the breaker and no Retry-After can park a web worker. The outbox backs off itself.
+    http = requests.Session()
+    retry = Retry(total=1, connect=1, read=0, status=0, redirect=0, backoff_factor=0.2, raise_on_status=False)
+    pool = int(os.environ.get("WHATSAPP_POOL_SIZE","10"))
+    http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool, max_retries=retry))
+    http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool, max_retries=retry))
+    return http
+
+whatsapp_http = make_whatsapp_http()
+whatsapp_breaker = CircuitBreaker(
+    threshold=int(os.environ.get("WHATSAPP_BREAKER_THRESHOLD","5")),
+    reset_seconds=float(os.environ.get("WHATSAPP_BREAKER_RESET_S","30")),
+)
+whatsapp_latency = LatencyHistogram()
+
+def post_whatsapp_text(to_e164: str, body: str):
+    # raises on any failure, so callers can record why; fails fast while the circuit is open
+    if not whatsapp_breaker.allow():
+        raise CircuitOpen("WhatsApp circuit open")
+    url = f"{WHATSAPP_API_BASE.rstrip('/')}/{os.environ.get('WHATSAPP_PHONE_ID')}/messages"
+    headers = {"Authorization": f"Bearer {os.environ.get('WHATSAPP_TOKEN')}", "Content-Type": "application/json"}
     data = {
         "messaging_product": "whatsapp",
         "to": to_e164,
         "type": "text",
         "text": {"body": body}
     }
+    t0 = monotonic()
     try:
-        r = requests.post(url, headers=headers, json=data, timeout=15)
-        r.raise_for_status()
+        r = whatsapp_http.post(url, headers=headers, json=data, timeout=WHATSAPP_TIMEOUT)
+    except requests.RequestException:
+        whatsapp_breaker.record_failure()
+        raise
+    finally:
+        whatsapp_latency.observe(monotonic() - t0)
+    if r.status_code >= 500 or r.status_code == 429:
+        whatsapp_breaker.record_failure()
+    else:
+        whatsapp_breaker.record_success()  # a 4xx is our request's fault, not an outage
+    if r.status_code >= 400:
+        raise requests.HTTPError(f"{r.status_code} {r.text[:200]}", response=r)
+
+def send_whatsapp_text(to_e164: str, body: str) -> bool:
+    if not whatsapp_configured() or not to_e164:
+        return False
+    try:
+        post_whatsapp_text(to_e164, body)
         return True
     except Exception as e:
-        print("WhatsApp send error:", e, getattr(r, "text", ""))
+        app.logger.warning("WhatsApp send error: %s", e)
+        return False
+
+def enqueue_whatsapp_text(to_e164: str, body: str) -> bool:
+    # added to the caller's transaction: the message exists iff the caller commits
+    if not whatsapp_configured() or not to_e164:
         return False
+    db.session.add(OutboxMessage(recipient=to_e164, body=body))
+    return True
+
+def claim_outbox_batch(limit, lease_minutes=5):
+    # due messages, plus "sending" ones whose worker died before the lease ran out
+    now = datetime.utcnow()
+    q = OutboxMessage.query.filter(
+        OutboxMessage.status.in_(("pending", "sending")), OutboxMessage.next_attempt_at <= now
+    ).order_by(OutboxMessage.next_attempt_at).limit(limit)
+    if db.engine.dialect.name == "postgresql":
+        q = q.with_for_update(skip_locked=True)
+    batch = []
+    for m in q.all():
+        m.status = "sending"
+        m.attempts += 1
+        m.next_attempt_at = now + timedelta(minutes=lease_minutes)
+        batch.append((m.id, m.recipient, m.body, m.attempts))
+    db.session.commit()
+    return batch
+
+def outbox_backoff(attempts, base_seconds=10, cap_seconds=3600):
+    return timedelta(seconds=min(cap_seconds, base_seconds * 2**(attempts - 1)))
+
+def drain_outbox(batch_size=50, concurrency=4):
+    batch = claim_outbox_batch(batch_size)
+    if not batch:
+        return 0, 0
+    def _send(item):
+        msg_id, recipient, body, attempts = item
+        try:
+            post_whatsapp_text(recipient, body)
+            return msg_id, attempts, None
+        except Exception as e:
+            return msg_id, attempts, e
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_send, batch))
+    now = datetime.utcnow()
+    sent = 0
+    for msg_id, attempts, error in results:
+        m = db.session.get(OutboxMessage, msg_id)
+        if error is None:
+            m.status, m.sent_at, m.last_error = "sent", now, None
+            sent += 1
+        elif isinstance(error, CircuitOpen):
+            # no request was made: the attempt is given back, so an outage cannot use up a message's tries
+            m.status, m.attempts, m.last_error = "pending", attempts - 1, str(error)
+            m.next_attempt_at = now + timedelta(seconds=whatsapp_breaker.reset_seconds)
+        else:
+            m.last_error = str(error)[:500] or error.__class__.__name__
+            m.status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+            m.next_attempt_at = now + outbox_backoff(attempts)
+    db.session.commit()
+    return len(batch), sent
+
+# Magic-link tokens: "db" stores a MagicToken row, "signed" issues a stateless HMAC token
+MAGIC_LINK_MODE = os.environ.get("MAGIC_LINK_MODE","db")
+MAGIC_LINK_TTL_MIN = 30
+magic_signer = URLSafeSerializer(app.secret_key, salt="magic-link")
+
+class ReplayFilter:
+    # nonces already used, bucketed by expiry minute: a whole bucket is dropped once it expires
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+    def first_use(self, nonce, expires_ts):
+        now = int(datetime.utcnow().timestamp())
+        with self.lock:
+            for b in [b for b in self.buckets if b * 60 + 60 < now]:
+                del self.buckets[b]
+            if any(nonce in seen for seen in self.buckets.values()):
+                return False
+            self.buckets.setdefault(int(expires_ts) // 60, set()).add(nonce)
+            return True
+
+class SqliteReplayFilter:
+    # same contract, shared by all gunicorn workers on the host
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS used_nonce (nonce TEXT PRIMARY KEY, expires_at INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_used_nonce_expires ON used_nonce (expires_at)")
+    def first_use(self, nonce, expires_ts):
+        now = int(datetime.utcnow().timestamp())
+        with sqlite3.connect(self.path, timeout=5) as conn:
+            conn.execute("DELETE FROM used_nonce WHERE expires_at < ?", (now,))
+            try:
+                conn.execute("INSERT INTO used_nonce (nonce, expires_at) VALUES (?, ?)", (nonce, int(expires_ts)))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+replay_filter = SqliteReplayFilter(os.environ["MAGIC_REPLAY_DB"]) if os.environ.get("MAGIC_REPLAY_DB") else ReplayFilter()
+
+def issue_magic_token(member_id, ttl_minutes=MAGIC_LINK_TTL_MIN):
+    expires = datetime.utcnow() + timedelta(minutes=ttl_minutes)
+    if MAGIC_LINK_MODE == "signed":
+        return magic_signer.dumps({"m": member_id, "e": int(expires.timestamp()), "n": secrets.token_urlsafe(9)})
+    token = secrets.token_urlsafe(32)
+    db.session.add(MagicToken(member_id=member_id, token=token, expires_at=expires))
+    return token
+
+def verify_signed_token(token):
+    # (member_id, error message); no database access
+    try:
+        payload = magic_signer.loads(token)
+    except BadSignature:
+        return None, "Link non valido."
+    if datetime.utcnow().timestamp() > payload["e"]:
+        return None, "Link scaduto. Richiedine uno nuovo."
+    if not replay_filter.first_use(payload["n"], payload["e"]):
+        return None, "Questo link è già stato usato. Richiedine uno nuovo."
+    return payload["m"], None
+
+def purge_magic_tokens(batch_size=500, pause=0.0):
+    # expired tokens in short id-bounded batches, one commit each, so locks are held for milliseconds.
+    # Used tokens go too: they expire within MAGIC_LINK_TTL_MIN of being issued.
+    cutoff = datetime.utcnow()
+    t = MagicToken.__table__
+    while True:
+        t0 = monotonic()
+        ids = [i for (i,) in db.session.query(MagicToken.id).filter(MagicToken.expires_at < cutoff).limit(batch_size)]
+        if not ids:
+            db.session.rollback()
+            return
+        db.session.execute(delete(t).where(t.c.id.in_(ids)))
+        db.session.commit()
+        yield len(ids), monotonic() - t0
+        if pause:
+            sleep(pause)
 
 # --- Customer session helpers ---
 def current_member():
     mid = session.get("member_id")
-    return Member.query.get(mid) if mid else None
+    if not mid:
+        return None
+    if g.get("member_id") != mid:
+        g.member_id, g.member = mid, db.session.get(Member, mid)
+    return g.member
 
 def require_member():
     m = current_member()
@@ -188,16 +1405,150 @@ def require_member():
         return redirect(url_for("magic_login_request"))
     return m
 
+# --- Request metrics ---
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS","0"))  # 0 = slow-request log off
+
+class RequestMetrics:
+    # per-endpoint latency histogram, request count by status, SQL statements and SQL time (this process)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(LatencyHistogram)
+        self.requests = defaultdict(int)
+        self.sql_statements = defaultdict(int)
+        self.sql_seconds = defaultdict(float)
+    def record(self, endpoint, status, seconds, sql_count, sql_seconds):
+        with self.lock:
+            hist = self.latency[endpoint]  # created under the lock: render_metrics iterates the dict
+            self.requests[(endpoint, status)] += 1
+            self.sql_statements[endpoint] += sql_count
+            self.sql_seconds[endpoint] += sql_seconds
+        hist.observe(seconds)
+
+request_metrics = RequestMetrics()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - context._query_start
+    if has_request_context() and "req_start" in g:
+        g.sql_count += 1
+        g.sql_seconds += elapsed
+        if SLOW_REQUEST_MS:
+            g.sql_log.append((elapsed, statement))
+
+with app.app_context():
+    event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(db.engine, "after_cursor_execute", _after_cursor_execute)
+
+@app.before_request
+def _start_request_timer():
+    g.req_start = perf_counter()
+    g.sql_count, g.sql_seconds, g.sql_log = 0, 0.0, []
+
+@app.after_request
+def _record_request_metrics(resp):
+    if "req_start" not in g:
+        return resp
+    elapsed = perf_counter() - g.req_start
+    endpoint = request.endpoint or "unmatched"
+    request_metrics.record(endpoint, resp.status_code, elapsed, g.sql_count, g.sql_seconds)
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        app.logger.warning(
+            "slow request %s %s: %.1f ms, %d SQL in %.1f ms\n%s", request.method, request.path,
+            elapsed * 1000, g.sql_count, g.sql_seconds * 1000,
+            "\n".join(f"  {t*1000:.1f} ms  {sql}" for t, sql in sorted(g.sql_log, reverse=True)[:20]),
+        )
+    return resp
+
+def prom_labels(**labels):
+    def esc(v): return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+def prom_histogram(name, hist, **labels):
+    snap = hist.snapshot()
+    lines = [f"{name}_bucket{prom_labels(**labels, le=le)} {n}" for le, n in snap["buckets"].items()]
+    lines.append(f"{name}_bucket{prom_labels(**labels, le='+Inf')} {snap['count']}")
+    lines.append(f"{name}_sum{prom_labels(**labels)} {snap['sum']}")
+    lines.append(f"{name}_count{prom_labels(**labels)} {snap['count']}")
+    return lines
+
+def render_metrics():
+    with request_metrics.lock:
+        latency = sorted(request_metrics.latency.items())
+        requests_ = sorted(request_metrics.requests.items())
+        statements = sorted(request_metrics.sql_statements.items())
+        sql_seconds = sorted(request_metrics.sql_seconds.items())
+    out = ["# TYPE pgym_http_request_duration_seconds histogram"]
+    for endpoint, hist in latency:
+        out += prom_histogram("pgym_http_request_duration_seconds", hist, endpoint=endpoint)
+    out.append("# TYPE pgym_http_requests_total counter")
+    out += [f"pgym_http_requests_total{prom_labels(endpoint=e, status=st)} {n}" for (e, st), n in requests_]
+    out.append("# TYPE pgym_sql_statements_total counter")
+    out += [f"pgym_sql_statements_total{prom_labels(endpoint=e)} {n}" for e, n in statements]
+    out.append("# TYPE pgym_sql_seconds_total counter")
+    out += [f"pgym_sql_seconds_total{prom_labels(endpoint=e)} {round(t, 6)}" for e, t in sql_seconds]
+    out.append("# TYPE pgym_whatsapp_request_duration_seconds histogram")
+    out += prom_histogram("pgym_whatsapp_request_duration_seconds", whatsapp_latency)
+    out.append("# TYPE pgym_whatsapp_circuit_open gauge")
+    out.append(f"pgym_whatsapp_circuit_open {int(whatsapp_breaker.snapshot()['state'] != 'closed')}")
+    cache = week_cache.stats()
+    out.append("# TYPE pgym_week_cache_hits_total counter")
+    out.append(f"pgym_week_cache_hits_total {cache['hits']}")
+    out.append("# TYPE pgym_week_cache_misses_total counter")
+    out.append(f"pgym_week_cache_misses_total {cache['misses']}")
+    return "\n".join(out) + "\n"
+
+# --- N+1 detector (development/tests) ---
+# "log" warns, "raise" fails the request; on by default with FLASK_DEBUG=1
+NPLUSONE = os.environ.get("NPLUSONE") or ("log" if os.environ.get("FLASK_DEBUG") == "1" else "")
+NPLUSONE_THRESHOLD = int(os.environ.get("NPLUSONE_THRESHOLD","3"))
+
+class NPlusOneError(Exception):
+    pass
+
+def template_location():
+    # "template.html:line" of the innermost Jinja frame on the stack
+    f = sys._getframe()
+    while f:
+        tmpl = f.f_globals.get("__jinja_template__")
+        if tmpl is not None:
+            return f"{tmpl.name}:{tmpl.get_corresponding_lineno(f.f_lineno)}"
+        f = f.f_back
+    return None
+
+@event.listens_for(OrmSession, "do_orm_execute")
+def _watch_lazy_loads(orm_execute_state):
+    # lazy_loaded_from only exists on SELECTs: check is_select first, or every ORM write would raise
+    if not NPLUSONE or not orm_execute_state.is_select or not has_request_context():
+        return
+    if orm_execute_state.lazy_loaded_from is None:
+        return
+    path = orm_execute_state.loader_strategy_path
+    prop = path.path[-1] if path is not None and path.path else None
+    rel = f"{prop.parent.class_.__name__}.{prop.key}" if hasattr(prop, "key") else str(path)
+    counts = g.setdefault("lazy_loads", defaultdict(int))
+    counts[rel] += 1
+    if counts[rel] != NPLUSONE_THRESHOLD:
+        return
+    msg = f"N+1: {rel} caricato lazy {NPLUSONE_THRESHOLD}+ volte in {request.endpoint}"
+    where = template_location()
+    if where:
+        msg += f" ({where})"
+    app.logger.warning(msg)
+    if NPLUSONE == "raise":
+        raise NPlusOneError(msg)
+
 # --- Routes (Public) ---
 @app.route("/")
 def index():
     today = date.today()
     start, end = week_bounds(today)
-    sessions = ClassSession.query.filter(ClassSession.date>=start, ClassSession.date<=end)        .order_by(ClassSession.date.asc(), ClassSession.start_time.asc()).all()
-    days = { (start + timedelta(days=i)): [] for i in range(7) }
-    for s in sessions:
-        days[s.date].append(s)
-    return render_template("index.html", days=days, start=start, end=end, brand=BRAND_NAME)
+    stamp = week_stamp(start)
+    key = week_cache_key("_index_week.html", start, stamp)
+    return conditional_page(key, data_last_modified(stamp[1], start), lambda: render_template(
+        "index.html", week_html=render_week("_index_week.html", start, key), start=start, end=end, brand=BRAND_NAME
+    ))
 
 @app.route("/calendar")
 def calendar_view():
@@ -209,20 +1560,136 @@ def calendar_view():
         ref_date = date.today()
     start = ref_date - timedelta(days=ref_date.weekday())
     end = start + timedelta(days=6)
-
-    sessions = ClassSession.query.filter(ClassSession.date>=start, ClassSession.date<=end)\
-        .order_by(ClassSession.date, ClassSession.start_time).all()
-
-    days = { (start + timedelta(days=i)): [] for i in range(7) }
-    for s in sessions:
-        days[s.date].append(s)
+    stamp = week_stamp(start)
+    key = week_cache_key("_calendar_week.html", start, stamp)
 
     prev_week = (start - timedelta(days=7)).strftime("%Y-%m-%d")
     next_week = (start + timedelta(days=7)).strftime("%Y-%m-%d")
 
-    return render_template("calendar.html", days=days, start=start, end=end,
-                           prev_week=prev_week, next_week=next_week, brand=BRAND_NAME)
+    return conditional_page(key, data_last_modified(stamp[1], None if week_str else start), lambda: render_template(
+        "calendar.html", week_html=render_week("_calendar_week.html", start, key), start=start, end=end,
+        prev_week=prev_week, next_week=next_week, live=LIVE_AVAILABILITY, brand=BRAND_NAME
+    ))
+
+
+API_MAX_RANGE_DAYS = 366
+
+def availability_json(s):
+    return {
+        "id": s.id, "title": s.title, "coach": s.coach,
+        "start": datetime.combine(s.date, s.start_time).isoformat(timespec="minutes"),
+        "end": datetime.combine(s.date, s.end_time).isoformat(timespec="minutes"),
+        "capacity": s.capacity, "spots_left": s.spots_left,
+    }
+
+def parse_range_args(default_days=6):
+    # ?from=&to= (YYYY-MM-DD), defaulting to the week ahead; (start, end, error)
+    try:
+        start = parse_date(request.args["from"]) if request.args.get("from") else date.today()
+        end = parse_date(request.args["to"]) if request.args.get("to") else start + timedelta(days=default_days)
+    except ValueError:
+        return None, None, "date non valide (YYYY-MM-DD)"
+    if end < start or (end - start).days > API_MAX_RANGE_DAYS:
+        return None, None, f"intervallo non valido (max {API_MAX_RANGE_DAYS} giorni)"
+    return start, end, None
+
+@app.route("/api/availability")
+def api_availability():
+    start, end, error = parse_range_args()
+    if error:
+        return jsonify(error=error), 400
+    stamp = range_stamp(start, end)
+    def generate():
+        yield f'{{"from":"{start.isoformat()}","to":"{end.isoformat()}","sessions":['
+        sep = ""
+        for s in iter_sessions(start, end):
+            yield sep + json.dumps(availability_json(s), separators=(",", ":"))
+            sep = ","
+        yield "]}"
+    return conditional_response(
+        ("availability", start, end, stamp[:2], virtual_fingerprint()),
+        data_last_modified(stamp[2], None if request.args.get("from") else start),
+        lambda: Response(stream_with_context(generate()), mimetype="application/json"),
+    )
 
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS","300"))
+
+@app.route("/api/availability/stream")
+def availability_stream():
+    # Server-Sent Events: spots-left deltas for one week. Each stream ends after SSE_MAX_SECONDS and
+    # the browser reconnects.
+    if not LIVE_AVAILABILITY:
+        return "", 204  # tells EventSource not to reconnect
+    try:
+        ref = parse_date(request.args["week"]) if request.args.get("week") else date.today()
+    except ValueError:
+        return jsonify(error="settimana non valida (YYYY-MM-DD)"), 400
+    topic = week_of(ref).isoformat()
+    def generate():
+        q = pubsub.subscribe(topic)
+        deadline = monotonic() + SSE_MAX_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            while monotonic() < deadline:
+                try:
+                    payload = q.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+        finally:
+            pubsub.unsubscribe(topic, q)
+    resp = Response(generate(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+def next_open_sessions(after, title, coach=None, n=5):
+    # one query on ix_class_session_open, ordered by (date, start_time)
+    q = ClassSession.query.filter(
+        ClassSession.title == title,
+        ClassSession.booked_count < ClassSession.capacity,
+        ClassSession.date >= after.date(),
+        or_(ClassSession.date > after.date(), ClassSession.start_time >= after.time()),
+    )
+    if coach:
+        q = q.filter(ClassSession.coach == coach)
+    return q.order_by(ClassSession.date, ClassSession.start_time).limit(n).all()
+
+def next_available(after, title="Personal", coach=None, n=5):
+    rows = next_open_sessions(after, title, coach, n)
+    if not VIRTUAL_SLOTS or title != "Personal":
+        return rows
+    # virtual slots are free by definition: walk the schedule a week at a time until n slots are found
+    settings = ensure_settings()
+    horizon = date.today() + timedelta(weeks=settings.weeks_ahead)
+    found = []
+    day = max(after.date(), date.today())
+    while day <= horizon and len(found) < n:
+        chunk_end = min(day + timedelta(days=6), horizon)
+        existing = {tuple(r) for r in db.session.query(ClassSession.date, ClassSession.start_time).filter(
+            ClassSession.title == "Personal", ClassSession.location == DEFAULT_LOCATION,
+            ClassSession.date >= day, ClassSession.date <= chunk_end)}
+        for d in daterange(day, chunk_end):
+            for st, en, c in slot_ranges_for_personal(d, settings):
+                slot_coach = c or settings.personal_coach or None
+                if (d, st) in existing or datetime.combine(d, st) < after or (coach and slot_coach != coach):
+                    continue
+                found.append(VirtualSlot(d, st, en, slot_coach, settings.personal_capacity))
+        day = chunk_end + timedelta(days=1)
+    merged = sorted(rows + found, key=lambda s: (s.date, s.start_time))
+    return merged[:n]
+
+@app.route("/api/next-available")
+def api_next_available():
+    try:
+        after = datetime.strptime(request.args["after"], "%Y-%m-%dT%H:%M") if request.args.get("after") else datetime.now()
+        n = min(max(int(request.args.get("n", 5)), 1), 50)
+    except ValueError:
+        return jsonify(error="parametri non validi (after=YYYY-MM-DDTHH:MM, n intero)"), 400
+    title = request.args.get("type") or "Personal"
+    slots = next_available(after, title, request.args.get("coach") or None, n)
+    return jsonify(slots=[availability_json(s) for s in slots])
 
 @app.route("/register", methods=["GET","POST"])
 def register():
@@ -260,10 +1727,8 @@ def magic_login_request():
                 return redirect(url_for("magic_login_request"))
             member = Member(name="Cliente", email=email or None, phone=phone or None)
             db.session.add(member); db.session.flush()
-        token = secrets.token_urlsafe(32)
-        ttl_minutes = 30
-        mt = MagicToken(member_id=member.id, token=token, expires_at=datetime.utcnow()+timedelta(minutes=ttl_minutes))
-        db.session.add(mt); db.session.commit()
+        ttl_minutes = MAGIC_LINK_TTL_MIN
+        token = issue_magic_token(member.id, ttl_minutes)
         site_url = os.environ.get("SITE_URL")
         base = site_url.rstrip("/") if site_url else request.host_url.rstrip("/")
         link = f"{base}/m/{token}"
@@ -273,8 +1738,13 @@ def magic_login_request():
             f"⏱️ Valido per {ttl_minutes} minuti."
         )
         sent = False
-        if member.phone:
-            sent = send_whatsapp_text(member.phone, msg)
+        if WHATSAPP_OUTBOX:
+            sent = enqueue_whatsapp_text(member.phone, msg)
+            db.session.commit()
+        else:
+            db.session.commit()
+            if member.phone:
+                sent = send_whatsapp_text(member.phone, msg)
         if sent:
             flash("Ti abbiamo inviato il link via WhatsApp 👍", "success")
             return redirect(url_for("index"))
@@ -284,6 +1754,13 @@ def magic_login_request():
 
 @app.route("/m/<token>")
 def magic_login_token(token):
+    if "." in token:  # signed token: plain DB tokens never contain a dot
+        member_id, error = verify_signed_token(token)
+        if error:
+            flash(error, "warning"); return redirect(url_for("magic_login_request"))
+        session["member_id"] = member_id
+        flash("Accesso effettuato!", "success")
+        return redirect(url_for("member_profile"))
     mt = MagicToken.query.filter_by(token=token).first()
     if not mt:
         flash("Link non valido.", "danger"); return redirect(url_for("magic_login_request"))
@@ -301,8 +1778,10 @@ def member_profile():
     m = current_member()
     if not m:
         return require_member()
-    bookings = Booking.query.filter_by(member_id=m.id).order_by(Booking.created_at.desc()).all()
-    return render_template("profile.html", member=m, bookings=bookings, brand=BRAND_NAME)
+    bookings = Booking.query.filter_by(member_id=m.id).options(joinedload(Booking.class_session))\
+        .order_by(Booking.created_at.desc()).all()
+    return render_template("profile.html", member=m, bookings=bookings, feed_url=member_feed_url(m),
+                           entries_left=member_remaining_entries(m.id), brand=BRAND_NAME)
 
 @app.route("/logout-member")
 def logout_member():
@@ -314,56 +1793,209 @@ def logout_member():
 @app.route("/admin/classes/<int:class_id>")
 def class_detail(class_id):
     cs = ClassSession.query.get_or_404(class_id)
-    spots_left = cs.capacity - len(cs.bookings)
-    return render_template("class_detail.html", cs=cs, spots_left=spots_left, brand=BRAND_NAME)
+    spots_left = cs.spots_left
+    validators = (cs.id, cs.title, cs.coach, cs.date, cs.start_time, cs.end_time, cs.location, cs.capacity, cs.booked_count)
+    return conditional_page(validators, week_stamp(week_of(cs.date))[1], lambda: render_template(
+        "class_detail.html", cs=cs, spots_left=spots_left, brand=BRAND_NAME
+    ))
 
 @app.route("/book/<int:class_id>", methods=["GET","POST"])
 def book(class_id):
     cs = ClassSession.query.get_or_404(class_id)
-    spots_left = cs.capacity - len(cs.bookings)
+    spots_left = cs.spots_left
     if request.method == "POST":
-        name = request.form["name"].strip()
-        email = request.form.get("email","").strip()
-        phone = request.form.get("phone","").strip()
-        member = None
-        if email: member = Member.query.filter_by(email=email).first()
-        if not member and name: member = Member.query.filter_by(name=name).first()
-        if not member:
-            member = Member(name=name or "Cliente", email=email or None, phone=phone or None)
-            db.session.add(member); db.session.flush()
-        if len(cs.bookings) >= cs.capacity:
-            flash("Capienza raggiunta.", "danger"); db.session.rollback(); return redirect(url_for("index"))
-        booking = Booking(member_id=member.id, class_id=cs.id)
-        db.session.add(booking); db.session.commit()
+        member = current_member()
+        outcome = book_class(
+            cs.id, request.form["name"].strip(),
+            request.form.get("email","").strip(), request.form.get("phone","").strip(),
+            member_id=member.id if member else None,
+        )
+        if outcome == "full":
+            flash("Capienza raggiunta.", "danger"); return redirect(url_for("index"))
+        if outcome == "duplicate":
+            flash("Sei già prenotato per questa lezione.", "warning")
+            return redirect(url_for("class_detail", class_id=class_id))
+        if outcome == "no_entries":
+            flash("Non hai ingressi disponibili nel pacchetto.", "danger")
+            return redirect(url_for("class_detail", class_id=class_id))
         flash("Prenotazione effettuata!", "success")
-        return redirect(url_for("class_detail", class_id=cs.id))
+        return redirect(url_for("class_detail", class_id=class_id))
     return render_template("book.html", cs=cs, spots_left=spots_left, brand=BRAND_NAME)
 
+@app.route("/book/personal/<day>/<start>", methods=["GET","POST"])
+def book_slot(day, start):
+    try:
+        slot = virtual_slot(parse_date(day), parse_time(start))
+    except ValueError:
+        abort(404)
+    if not slot:
+        return redirect(url_for("index"))
+    cs = ClassSession.query.filter_by(
+        title=slot.title, date=slot.date, start_time=slot.start_time, end_time=slot.end_time, location=slot.location
+    ).first()
+    if cs:
+        return redirect(url_for("book", class_id=cs.id), code=307)
+    if request.method == "POST":
+        cs = materialize_slot(slot)
+        db.session.commit()
+        return book(cs.id)
+    return render_template("book.html", cs=slot, spots_left=slot.capacity, brand=BRAND_NAME)
+
+# --- iCalendar ---
+def ics_escape(value):
+    return str(value).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")\
+        .replace("\r\n", "\\n").replace("\n", "\\n")
+
+def ics_fold(line):
+    # RFC 5545: at most 75 octets per line, continuation lines start with a space
+    if len(line.encode("utf-8")) <= 75:
+        return line + "\r\n"
+    parts, cur, size, limit = [], [], 0, 75
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > limit:
+            parts.append("".join(cur))
+            cur, size, limit = [], 0, 74
+        cur.append(ch)
+        size += n
+    parts.append("".join(cur))
+    return "\r\n ".join(parts) + "\r\n"
+
+def ics_dt(d, t):
+    return datetime.combine(d, t).strftime("%Y%m%dT%H%M%S")
+
+def ics_event(uid, cs, stamp, summary, description=""):
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{stamp.strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART:{ics_dt(cs.date, cs.start_time)}",
+        f"DTEND:{ics_dt(cs.date, cs.end_time)}",
+        f"SUMMARY:{ics_escape(summary)}",
+        f"LOCATION:{ics_escape(cs.location or '')}",
+    ]
+    if description:
+        lines.append(f"DESCRIPTION:{ics_escape(description)}")
+    lines.append("END:VEVENT")
+    return "".join(ics_fold(l) for l in lines)
+
+def ics_stream(events, name=None):
+    # generator of calendar text; `events` is an iterable of ics_event() strings
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Pgym//IT\r\nCALSCALE:GREGORIAN\r\n"
+    if name:
+        yield ics_fold(f"X-WR-CALNAME:{ics_escape(name)}")
+    yield from events
+    yield "END:VCALENDAR\r\n"
+
+def ics_response(build_stream, filename=None):
+    resp = Response(stream_with_context(build_stream()), mimetype="text/calendar")
+    resp.headers["Content-Type"] = "text/calendar; charset=utf-8"
+    if filename:
+        resp.headers["Content-Disposition"] = f"inline; filename={filename}"
+    return resp
+
+def member_feed_url(member):
+    if not member.calendar_token:
+        member.calendar_token = secrets.token_urlsafe(24)
+        db.session.commit()
+    url = url_for("ics_member", token=member.calendar_token, _external=True)
+    return "webcal://" + url.split("://", 1)[1]
+
+@app.route("/ics/member/<token>.ics")
+def ics_member(token):
+    # subscription feed of the member's upcoming bookings; polled clients mostly get a 304
+    member = Member.query.filter_by(calendar_token=token).first_or_404()
+    n, last_id, last_change = db.session.query(
+        func.count(Booking.id), func.max(Booking.id), func.max(Booking.created_at)
+    ).filter(Booking.member_id == member.id).one()
+    today = date.today()
+    def events():
+        rows = db.session.query(Booking.id, Booking.created_at, ClassSession)\
+            .join(ClassSession, ClassSession.id == Booking.class_id)\
+            .filter(Booking.member_id == member.id, ClassSession.date >= today)\
+            .order_by(ClassSession.date, ClassSession.start_time).yield_per(200)
+        for booking_id, created_at, cs in rows:
+            yield ics_event(f"booking-{booking_id}@pgym", cs, created_at or datetime.utcnow(),
+                            f"{cs.title} con {cs.coach or 'coach'}", f"Prenotazione per {member.name}")
+    # past bookings drop out of the body as days pass, so it is never older than today's midnight
+    midnight = datetime.combine(today, time())
+    return conditional_response(
+        ("member-feed", member.id, member.name, n, last_id, last_change, today), max(last_change, midnight) if last_change else midnight,
+        lambda: ics_response(lambda: ics_stream(events(), f"{BRAND_NAME} — {member.name}"), "pgym.ics"),
+        "private, no-cache",
+    )
+
 @app.route("/ics/booking/<int:booking_id>.ics")
 def ics_booking(booking_id):
     b = Booking.query.get_or_404(booking_id)
     s = b.class_session
-    dt_start = datetime.combine(s.date, s.start_time)
-    dt_end = datetime.combine(s.date, s.end_time)
-    ics = f"""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:-//Pgym//IT
-BEGIN:VEVENT
-UID:booking-{b.id}@pgym
-DTSTAMP:{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}
-DTSTART:{dt_start.strftime('%Y%m%dT%H%M%S')}
-DTEND:{dt_end.strftime('%Y%m%dT%H%M%S')}
-SUMMARY:{s.title} con {s.coach or 'coach'}
-LOCATION:{s.location or ''}
-DESCRIPTION:Prenotazione per {b.member.name}
-END:VEVENT
-END:VCALENDAR
-"""
-    resp = make_response(ics)
+    event = ics_event(f"booking-{b.id}@pgym", s, datetime.utcnow(), f"{s.title} con {s.coach or 'coach'}",
+                      f"Prenotazione per {b.member.name}")
+    resp = make_response("".join(ics_stream([event])))
     resp.headers["Content-Type"] = "text/calendar; charset=utf-8"
     resp.headers["Content-Disposition"] = f"attachment; filename=booking-{b.id}.ics"
     return resp
 
+feed_cache = ViewCache(maxsize=int(os.environ.get("FEED_CACHE_SIZE","64")), shared=week_cache.shared)
+
+def sessions_feed(name, start, end, coach=None, filename="pgym.ics", implicit=False):
+    # shared by every subscriber: rendered once per data version of the range, then cached (or 304)
+    count, version, updated_at = range_stamp(start, end)
+    key = f"ics:{coach or '*'}:{start.isoformat()}:{end.isoformat()}:{count}:{version}"
+    stamp = updated_at or datetime(2000, 1, 1)
+    def events():
+        q = ClassSession.query.filter(ClassSession.date>=start, ClassSession.date<=end)
+        if coach:
+            q = q.filter(ClassSession.coach == coach)
+        for cs in q.order_by(ClassSession.date, ClassSession.start_time).yield_per(500):
+            summary = cs.title if coach or not cs.coach else f"{cs.title} con {cs.coach}"
+            yield ics_event(f"class-{cs.id}@pgym", cs, stamp, summary)
+    render = lambda: feed_cache.get_or_render(key, lambda: "".join(ics_stream(events(), name)))
+    last_modified = data_last_modified(updated_at, start if implicit else None)
+    return conditional_response((key, name), last_modified, lambda: ics_response(lambda: [render()], filename))
+
+@app.route("/ics/coach/<name>.ics")
+def ics_coach(name):
+    start, end, error = parse_range_args(default_days=90)
+    if error:
+        return jsonify(error=error), 400
+    return sessions_feed(f"{BRAND_NAME} — {name}", start, end, coach=name, filename=f"{secure_filename(name) or 'coach'}.ics",
+                         implicit=not request.args.get("from"))
+
+@app.route("/ics/all.ics")
+def ics_all():
+    start, end, error = parse_range_args(default_days=90)
+    if error:
+        return jsonify(error=error), 400
+    return sessions_feed(BRAND_NAME, start, end, implicit=not request.args.get("from"))
+
+@app.route("/admin/reports")
+@login_required
+def admin_reports():
+    if current_user.role != "admin":
+        flash("Accesso riservato agli amministratori.", "danger"); return redirect(url_for("index"))
+    start, end, error = parse_range_args()
+    if error or not request.args.get("from"):
+        end = date.today()
+        start = end - timedelta(days=365)
+    return render_template("report.html", report=rollup_report(start, end), start=start, end=end, brand=BRAND_NAME)
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus text format, per gunicorn worker; METRICS_TOKEN (if set) is required as a bearer token
+    token = os.environ.get("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/health/cache")
+def cache_health():
+    return jsonify(week=week_cache.stats(), feeds=feed_cache.stats())
+
+@app.route("/health/whatsapp")
+def whatsapp_health():
+    return jsonify(breaker=whatsapp_breaker.snapshot(), latency_seconds=whatsapp_latency.snapshot())
+
 # --- Admin auth (placeholder minimal for this update) ---
 @app.route("/login", methods=["GET","POST"])
 def login():
@@ -386,6 +2018,7 @@ def logout():
 @app.cli.command("init-db")
 def init_db():
     db.create_all()
+    migrate_db()
     if not User.query.filter_by(role="admin").first():
         admin_email = os.environ.get("ADMIN_EMAIL","admin@pgym.local").lower()
         admin_pw = os.environ.get("ADMIN_PASSWORD","admin")
@@ -399,8 +2032,115 @@ def init_db():
         pass
     print("DB inizializzato, admin creato, slot Personal generati (se possibile).")
 
+@app.cli.command("outbox-worker")
+@click.option("--once", is_flag=True, help="Drain what is due and exit.")
+@click.option("--batch", "batch_size", default=50, show_default=True)
+@click.option("--concurrency", default=4, show_default=True)
+@click.option("--interval", default=2.0, show_default=True, help="Seconds to sleep when the outbox is empty.")
+def outbox_worker(once, batch_size, concurrency, interval):
+    while True:
+        claimed, sent = drain_outbox(batch_size, concurrency)
+        if claimed:
+            print(f"outbox: {sent}/{claimed} inviati", flush=True)
+        if once and not claimed:
+            break
+        if not claimed:
+            sleep(interval)
+
+@app.cli.command("purge-tokens")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--pause", default=0.05, show_default=True, help="Seconds between batches.")
+def purge_tokens(batch_size, pause):
+    total = 0
+    for removed, seconds in purge_magic_tokens(batch_size, pause):
+        total += removed
+        print(f"batch: {removed} token rimossi in {seconds*1000:.1f} ms", flush=True)
+    print(f"Token rimossi: {total}")
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    failed = 0
+    for name, query in hot_queries().items():
+        plan = explain(query)
+        bad = [line for line in plan if is_full_scan(line)]
+        failed += bool(bad)
+        print(f"[{'SCAN' if bad else 'ok'}] {name}")
+        for line in plan:
+            print("    ", line)
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command("sweep-packages")
+@click.option("--batch-size", default=500, show_default=True)
+def sweep_packages(batch_size):
+    # nightly: zero the expired packages; MemberBalance already answers "entries left" in one read
+    print(f"Pacchetti scaduti: {expire_packages(batch_size)}")
+
+@app.cli.command("rollup")
+def rollup_cmd():
+    # incremental; safe to run from cron as often as wanted
+    for source, groups in run_rollups().items():
+        print(f"{source}: {groups} gruppi aggiornati")
+
+@app.cli.command("rebuild-balances")
+def rebuild_balances_cmd():
+    print(f"Saldi ricalcolati: {rebuild_balances()} clienti")
+
+@app.cli.command("reconcile-counts")
+@click.option("--fix", is_flag=True, help="Rewrite the drifted counters.")
+def reconcile_counts(fix):
+    drift = booked_count_drift()
+    for class_id, stored, actual in drift:
+        print(f"class {class_id}: booked_count={stored} bookings={actual}")
+    if fix and drift:
+        fix_booked_counts(drift)
+    print(f"Sessioni con drift: {len(drift)}" + (" (corrette)" if fix and drift else ""))
+
+@app.cli.command("schedule-set")
+@click.argument("weekday", type=click.IntRange(0, 6))
+@click.argument("blocks", nargs=-1)
+@click.option("--coach", default=None)
+@click.option("--slot-min", type=int, default=None, help="Slot length; default AppSettings.personal_duration_min.")
+@click.option("--location", default=DEFAULT_LOCATION)
+def schedule_set(weekday, blocks, coach, slot_min, location):
+    # es. flask schedule-set 5 09:00-11:00 16:00-19:00  (no blocks = closed that day)
+    # Replaces only the blocks of --coach (none = the uncoached ones): run it once per coach.
+    try:
+        parsed = [tuple(parse_time(t) for t in b.split("-")) for b in blocks]
+    except ValueError:
+        raise click.BadParameter("blocchi nel formato HH:MM-HH:MM", param_hint="BLOCKS")
+    if not ScheduleBlock.query.filter_by(location=location).first():
+        for wd, sh, eh in DEFAULT_WEEKLY_BLOCKS:
+            db.session.add(ScheduleBlock(location=location, weekday=wd, start_time=time(sh), end_time=time(eh)))
+        db.session.flush()
+    day_blocks = ScheduleBlock.query.filter_by(location=location, weekday=weekday).all()
+    others = [(b.start_time, b.end_time) for b in day_blocks if b.coach != coach]
+    for a, b in overlapping_blocks(parsed + others):
+        db.session.rollback()
+        raise click.BadParameter(f"{a[0]:%H:%M}-{a[1]:%H:%M} e {b[0]:%H:%M}-{b[1]:%H:%M} si sovrappongono", param_hint="BLOCKS")
+    for old in day_blocks:
+        if old.coach == coach:
+            db.session.delete(old)
+    for start, end in parsed:
+        db.session.add(ScheduleBlock(location=location, coach=coach, weekday=weekday,
+                                     start_time=start, end_time=end, slot_minutes=slot_min))
+    db.session.commit()
+    for start, end, c in compiled_schedule(location=location)[weekday]:
+        print(start.strftime("%H:%M"), end.strftime("%H:%M"), c or "")
+    if location == DEFAULT_LOCATION:
+        # the watermark was reset: regenerate now, so removed slots stop being bookable right away
+        print(f"Slot Personal creati: {upsert_personal_slots()}")
+
+@app.cli.command("materialize-slots")
+@click.option("--full", is_flag=True, help="Ignore the watermark and rescan the whole horizon.")
+def materialize_slots(full):
+    # cheap enough for cron every few minutes: a no-op until a new day enters the horizon
+    created = upsert_personal_slots(full=full)
+    print(f"Slot Personal creati: {created}")
+
 with app.app_context():
     db.create_all()
+    migrate_db()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,51 @@
+# Shared setup for the benchmark scripts: run them from the repo root, e.g. `python bench/upsert_slots.py`.
+# BENCH_DATABASE_URL picks the database (e.g. a local Postgres); default is a scratch SQLite file.
+# The schema of that database is dropped and recreated.
+import os, statistics, sys, tempfile
+from time import perf_counter
+
+_tmp = tempfile.mkdtemp(prefix="pgym-bench-")
+os.environ["DATABASE_URL"] = os.environ.get("BENCH_DATABASE_URL") or f"sqlite:///{os.path.join(_tmp, 'bench.db')}"
+os.environ.setdefault("PUBSUB_BACKEND", "memory")
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_root, os.path.join(_root, "tests")]
+
+import app as pgym  # noqa: E402
+
+
+def reset(**settings):
+    # fresh schema, empty in-process caches, AppSettings with the given overrides
+    with pgym.app.app_context():
+        pgym.db.session.remove()
+        pgym.db.drop_all()
+        pgym.db.create_all()
+        pgym.db.session.add(pgym.AppSettings(**settings))
+        pgym.db.session.commit()
+        pgym.db.session.remove()
+    pgym._settings_cache.update(version=None, snapshot=None)
+    pgym._schedule_cache.clear()
+    for cache in (pgym.week_cache, pgym.feed_cache):
+        cache.local.clear()
+        cache.hits = cache.misses = 0
+
+
+def timed(fn, repeat=1):
+    # (result of the last call, median wall time in ms)
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        result = fn()
+        times.append((perf_counter() - t0) * 1000)
+    return result, statistics.median(times)
+
+
+def report(title, header, rows):
+    print(f"\n{title}  [{dialect()}]")
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in (header, *rows):
+        print("  " + "  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+
+def dialect():
+    with pgym.app.app_context():
+        return pgym.db.engine.dialect.name
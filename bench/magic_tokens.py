@@ -0,0 +1,54 @@
+# Benchmark: magic-link issue and verify latency, MagicToken rows ("db") vs signed tokens.
+# python bench/magic_tokens.py [links] [old_tokens]
+import os, sys, tempfile
+from datetime import datetime, timedelta
+
+from common import pgym, report, reset, timed
+
+LINKS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+OLD_TOKENS = int(sys.argv[2]) if len(sys.argv) > 2 else 20000  # rows left behind by earlier logins
+
+
+def seed():
+    reset()
+    with pgym.app.app_context():
+        pgym.db.session.add(pgym.Member(name="Cliente", phone="+393330000000"))
+        pgym.db.session.flush()
+        expired = datetime.utcnow() - timedelta(days=1)
+        pgym.db.session.execute(pgym.MagicToken.__table__.insert(), [
+            dict(member_id=1, token=f"old-{i}", expires_at=expired, used=True) for i in range(OLD_TOKENS)])
+        pgym.db.session.commit()
+        pgym.db.session.remove()
+
+
+def run(mode, replay_filter):
+    seed()
+    pgym.MAGIC_LINK_MODE = mode
+    pgym.replay_filter = replay_filter
+    client = pgym.app.test_client()
+
+    def issue():
+        with pgym.app.app_context():
+            tokens = []
+            for _ in range(LINKS):  # one transaction per link, as /login-magic does
+                tokens.append(pgym.issue_magic_token(1))
+                pgym.db.session.commit()
+        return tokens
+
+    def verify():
+        return [client.get(f"/m/{t}").headers["Location"] for t in tokens]
+
+    tokens, issue_ms = timed(issue)
+    locations, verify_ms = timed(verify)
+    assert all(loc.endswith("/me") for loc in locations)
+    replayed = client.get(f"/m/{tokens[0]}").headers["Location"]
+    assert not replayed.endswith("/me")
+    name = mode if mode == "db" else f"signed, {type(replay_filter).__name__}"
+    return name, f"{issue_ms * 1000 / LINKS:.0f}", f"{verify_ms * 1000 / LINKS:.0f}"
+
+
+if __name__ == "__main__":
+    nonces = os.path.join(tempfile.mkdtemp(prefix="pgym-bench-"), "nonces.db")
+    rows = [run("db", pgym.ReplayFilter()), run("signed", pgym.ReplayFilter()),
+            run("signed", pgym.SqliteReplayFilter(nonces))]
+    report(f"{LINKS} magic links, {OLD_TOKENS} old MagicToken rows", ("mode", "issue µs", "verify µs"), rows)
@@ -0,0 +1,52 @@
+# Benchmark: next free Personal slots on years of sessions, indexed query vs paging week by week.
+# python bench/next_available.py [years] [full_weeks]
+import sys
+from datetime import date, datetime, time, timedelta
+
+from common import pgym, report, reset, timed
+from querycount import count_queries
+
+YEARS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+FULL_WEEKS = int(sys.argv[2]) if len(sys.argv) > 2 else 26  # booked solid from today
+SLOTS_PER_DAY = 10
+
+
+def seed(today):
+    # one year of past sessions, then YEARS ahead
+    reset()
+    first_day = today - timedelta(days=365)
+    with pgym.app.app_context():
+        free_from = today + timedelta(weeks=FULL_WEEKS)
+        pgym.db.session.execute(pgym.ClassSession.__table__.insert(), [
+            dict(title="Personal", coach="Anna", date=d, start_time=time(8 + h), end_time=time(9 + h), capacity=2,
+                 booked_count=2 if d < free_from else 0, location=pgym.DEFAULT_LOCATION)
+            for d in pgym.daterange(first_day, today + timedelta(days=365 * YEARS)) for h in range(SLOTS_PER_DAY)])
+        pgym.db.session.commit()
+        rows = pgym.ClassSession.query.count()
+        pgym.db.session.remove()
+    return rows
+
+
+def paging_weeks(after, n=5):
+    # what a client had to do before /api/next-available: load week after week until n free slots show up
+    found, start = [], after.date() - timedelta(days=after.weekday())
+    while len(found) < n:
+        for d, items in sorted(pgym.week_days(start).items()):
+            found += [s for s in items if s.title == "Personal" and s.spots_left > 0
+                      and datetime.combine(d, s.start_time) >= after]
+        start += timedelta(days=7)
+    return found[:n]
+
+
+if __name__ == "__main__":
+    today = date.today()
+    rows = seed(today)
+    after = datetime.combine(today, time(0))
+    results = []
+    with pgym.app.app_context():
+        for name, search in (("week paging", paging_weeks), ("next_available", pgym.next_available)):
+            with count_queries() as statements:
+                slots, ms = timed(lambda: search(after), repeat=5)
+            results.append((name, slots[0].date.isoformat(), len(statements) // 5, f"{ms:.2f}"))
+    report(f"{rows} Personal slots (1 year past, {YEARS} ahead), next {FULL_WEEKS} weeks full",
+           ("search", "first free", "statements", "ms"), results)
@@ -0,0 +1,48 @@
+# Benchmark: round trips and wall time of upsert_personal_slots against the old per-slot loop.
+# python bench/upsert_slots.py [weeks]   (BENCH_DATABASE_URL=postgresql://... for Postgres)
+import sys
+from datetime import date, timedelta
+
+from common import pgym, report, reset, timed
+from querycount import count_queries
+
+WEEKS = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+
+
+def per_slot_upsert():
+    # the previous implementation: one SELECT per candidate slot, one INSERT per missing one
+    settings = pgym.ensure_settings()
+    today = date.today()
+    created = 0
+    for d in pgym.daterange(today, today + timedelta(weeks=settings.weeks_ahead)):
+        for start, end, coach in pgym.slot_ranges_for_personal(d, settings):
+            exists = pgym.ClassSession.query.filter_by(
+                title="Personal", date=d, start_time=start, end_time=end, location=pgym.DEFAULT_LOCATION).first()
+            if not exists:
+                pgym.db.session.add(pgym.ClassSession(
+                    title="Personal", coach=coach or settings.personal_coach or None, date=d, start_time=start,
+                    end_time=end, capacity=settings.personal_capacity, location=pgym.DEFAULT_LOCATION))
+                created += 1
+    pgym.db.session.commit()
+    return created
+
+
+def measure(upsert):
+    # first run on an empty table, then a re-run with every slot already there
+    reset(weeks_ahead=WEEKS)
+    rows = []
+    with pgym.app.app_context():
+        pgym.ensure_settings()
+        for run in ("empty", "re-run"):
+            with count_queries() as statements:
+                created, ms = timed(upsert)
+            rows.append((upsert.__name__, run, created, len(statements), f"{ms:.1f}"))
+        pgym.db.session.remove()
+    return rows
+
+
+if __name__ == "__main__":
+    full = lambda: pgym.upsert_personal_slots(full=True)
+    full.__name__ = "bulk (full=True)"
+    report(f"Personal slots, {WEEKS}-week horizon", ("mode", "run", "created", "statements", "ms"),
+           measure(per_slot_upsert) + measure(pgym.upsert_personal_slots) + measure(full))
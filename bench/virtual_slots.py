@@ -0,0 +1,63 @@
+# Benchmark: ClassSession rows and calendar time over a 52-week horizon, materialized vs virtual slots.
+# python bench/virtual_slots.py [weeks] [booked_every]
+import sys
+from datetime import date, timedelta
+
+from sqlalchemy import update
+
+from common import pgym, report, reset, timed
+from querycount import count_queries
+
+WEEKS = int(sys.argv[1]) if len(sys.argv) > 1 else 52
+BOOKED_EVERY = int(sys.argv[2]) if len(sys.argv) > 2 else 20  # one slot in N has a booking
+
+
+def seed(virtual):
+    reset(weeks_ahead=WEEKS)
+    pgym.VIRTUAL_SLOTS = virtual
+    with pgym.app.app_context():
+        settings = pgym.ensure_settings()
+        today = date.today()
+        slots = [(d, st, en, c) for d in pgym.daterange(today, today + timedelta(weeks=WEEKS))
+                 for st, en, c in pgym.slot_ranges_for_personal(d, settings)]
+        booked = slots[::BOOKED_EVERY]
+        if virtual:
+            for d, st, en, c in booked:
+                pgym.materialize_slot(pgym.VirtualSlot(d, st, en, c, settings.personal_capacity))
+        else:
+            pgym.upsert_personal_slots()
+        t = pgym.ClassSession.__table__
+        for d, st, _, _ in booked:
+            pgym.db.session.execute(update(t).where(
+                t.c.title == "Personal", t.c.date == d, t.c.start_time == st).values(booked_count=1))
+        pgym.db.session.commit()
+        rows = pgym.ClassSession.query.count()
+        pgym.db.session.remove()
+    return rows
+
+
+def calendar_times(client):
+    # every week of the horizon, uncached: (median ms per page, statements per page)
+    today = date.today()
+    weeks = [(today + timedelta(weeks=w)).isoformat() for w in range(WEEKS)]
+    times, statements = [], 0
+    for week in weeks:
+        with count_queries() as seen:
+            resp, ms = timed(lambda: client.get(f"/calendar?week={week}"))
+        assert resp.status_code == 200
+        times.append(ms)
+        statements += len(seen)
+    times.sort()
+    return times[len(times) // 2], statements / len(weeks)
+
+
+if __name__ == "__main__":
+    pgym.week_cache.maxsize = 0
+    client = pgym.app.test_client()
+    rows = []
+    for virtual in (False, True):
+        count = seed(virtual)
+        ms, statements = calendar_times(client)
+        rows.append(("virtual" if virtual else "materialized", count, f"{statements:.1f}", f"{ms:.2f}"))
+    report(f"Personal slots, {WEEKS}-week horizon, 1 in {BOOKED_EVERY} booked",
+           ("mode", "ClassSession rows", "statements/page", "ms/page"), rows)
@@ -0,0 +1,42 @@
+# Benchmark: hit ratio and latency of the week pages with and without the week-view cache.
+# python bench/week_cache.py [requests] [book_every]
+import random, statistics, sys
+from datetime import date, timedelta
+
+from common import pgym, report, reset, timed
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+BOOK_EVERY = int(sys.argv[2]) if len(sys.argv) > 2 else 50  # one booking per N page views
+WEEKS = 4
+
+
+def run(maxsize):
+    reset(weeks_ahead=WEEKS)
+    pgym.week_cache.maxsize = maxsize
+    with pgym.app.app_context():
+        pgym.upsert_personal_slots()
+        slot_ids = [i for (i,) in pgym.db.session.query(pgym.ClassSession.id)]
+        pgym.db.session.remove()
+    rnd = random.Random(42)
+    today = date.today()
+    urls = ["/"] + [f"/calendar?week={(today + timedelta(weeks=w)).isoformat()}" for w in range(WEEKS)]
+    client = pgym.app.test_client()
+    times = []
+    for n in range(REQUESTS):
+        if n % BOOK_EVERY == 0:
+            with pgym.app.app_context():
+                pgym.book_class(rnd.choice(slot_ids), f"Cliente {n}", f"c{n}@example.com")
+                pgym.db.session.remove()
+        url = rnd.choice(urls)
+        resp, ms = timed(lambda: client.get(url))
+        assert resp.status_code == 200
+        times.append(ms)
+    stats = pgym.week_cache.stats()
+    times.sort()
+    return (f"WEEK_CACHE_SIZE={maxsize}", stats["hit_ratio"] if maxsize else "-",
+            f"{statistics.median(times):.2f}", f"{times[int(len(times) * 0.95)]:.2f}")
+
+
+if __name__ == "__main__":
+    report(f"{REQUESTS} week page views, one booking every {BOOK_EVERY}",
+           ("cache", "hit ratio", "median ms", "p95 ms"), [run(0), run(256)])
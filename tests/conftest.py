@@ -0,0 +1,149 @@
+import json, os, sys, tempfile, threading
+from datetime import date, time, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+import pytest
+
+# app.py binds its engine at import time: point it at a scratch database first.
+# TEST_DATABASE_URL runs the suite on another database (e.g. Postgres); it is dropped and recreated
+_tmp = tempfile.mkdtemp(prefix="pgym-tests-")
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL") or f"sqlite:///{os.path.join(_tmp, 'test.db')}"
+os.environ["PUBSUB_BACKEND"] = "memory"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as pgym  # noqa: E402
+
+
+def reset_state():
+    # fresh schema and empty in-process caches
+    with pgym.app.app_context():
+        pgym.db.session.remove()
+        pgym.db.drop_all()
+        pgym.db.create_all()
+        pgym.db.session.remove()
+    pgym._settings_cache.update(version=None, snapshot=None)
+    pgym._schedule_cache.clear()
+    for cache in (pgym.week_cache, pgym.feed_cache):
+        cache.local.clear()
+        cache.hits = cache.misses = 0
+
+
+@pytest.fixture
+def ctx():
+    # for tests that call the helpers directly: an app context held for the whole test
+    reset_state()
+    with pgym.app.app_context():
+        yield pgym
+        pgym.db.session.remove()
+
+
+@pytest.fixture
+def client():
+    # no app context around the requests: each one gets its own session and `g`, as in production.
+    # Set up data inside `with pgym.app.app_context():`.
+    reset_state()
+    return pgym.app.test_client()
+
+
+@pytest.fixture
+def fake_today(monkeypatch):
+    # call with a date to make app.py's date.today() return it, e.g. to cross a day or week rollover
+    def travel(day):
+        class FakeDate(date):
+            @classmethod
+            def today(cls):
+                return day
+        monkeypatch.setattr(pgym, "date", FakeDate)
+    return travel
+
+
+_race_summary = []
+
+
+@pytest.fixture
+def race_summary():
+    # lines for the terminal summary: throughput numbers stay visible without `-s`
+    return _race_summary
+
+
+def pytest_terminal_summary(terminalreporter):
+    if _race_summary:
+        terminalreporter.section("booking throughput")
+        for line in _race_summary:
+            terminalreporter.write_line(line)
+
+
+def make_class(title="Pilates", day=None, start=9, capacity=2, coach="Anna"):
+    cs = pgym.ClassSession(
+        title=title, coach=coach, date=day or date.today() + timedelta(days=1),
+        start_time=time(start), end_time=time(start + 1), capacity=capacity, location=pgym.DEFAULT_LOCATION,
+    )
+    pgym.db.session.add(cs)
+    pgym.db.session.commit()
+    return cs
+
+
+def run_forked(target, args_list):
+    # one process per args tuple, each with its own connection pool; returns the results in order
+    import multiprocessing
+    mp = multiprocessing.get_context("fork")
+    with mp.Pool(len(args_list), initializer=_reset_engine) as pool:
+        return pool.starmap(target, args_list)
+
+
+def _reset_engine():
+    with pgym.app.app_context():
+        pgym.db.engine.dispose(close=False)
+
+
+class StubGraphAPI:
+    # stand-in for the WhatsApp Cloud API: records each POST, answers with the queued replies
+    def __init__(self):
+        self.received = []
+        self.replies = []  # (status, headers); empty = 200
+        self.delay = 0.0  # seconds before each answer: a slow upstream
+        handler = self._handler()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.received.append(json.loads(body))
+                sleep(stub.delay)
+                status, headers = stub.replies.pop(0) if stub.replies else (200, {})
+                payload = b'{"messages":[{"id":"wamid.test"}]}' if status < 400 else b'{"error":{}}'
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client timed out while `delay` held the answer
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def graph_api(monkeypatch):
+    stub = StubGraphAPI()
+    monkeypatch.setenv("WHATSAPP_TOKEN", "test-token")
+    monkeypatch.setenv("WHATSAPP_PHONE_ID", "123")
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setattr(pgym, "WHATSAPP_API_BASE", stub.base)
+    monkeypatch.setattr(pgym, "whatsapp_breaker", pgym.CircuitBreaker(threshold=3, reset_seconds=60))
+    yield stub
+    stub.server.shutdown()
@@ -0,0 +1,24 @@
+# SQL statement counter shared by the tests and the benchmark scripts. It has none of conftest.py's
+# setup and reads app.py only when called, after conftest.py or bench/common.py chose the database.
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+@contextmanager
+def count_queries():
+    # collects the SQL statements run inside the block, e.g. to pin the query count of a page render;
+    # needs no app context around the block, so test-client requests get their own as in production
+    import app as pgym
+    with pgym.app.app_context():
+        engine = pgym.db.engine
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
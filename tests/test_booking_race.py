@@ -0,0 +1,61 @@
+from time import perf_counter
+
+from sqlalchemy import func
+
+from conftest import make_class, pgym, run_forked
+
+PROCESSES = 8
+ATTEMPTS_PER_PROCESS = 250
+SLOTS = 4
+CAPACITY = 100  # full only after ~a fifth of the attempts: until then every claim races the others
+
+
+def _book_many(worker, class_ids):
+    # every attempt is a different member, so only capacity can turn a booking down.
+    # Workers walk the slots from different offsets so several of them contend for each one.
+    outcomes = {}
+    with pgym.app.app_context():
+        for i in range(ATTEMPTS_PER_PROCESS):
+            class_id = class_ids[(worker + i) % len(class_ids)]
+            try:
+                outcome = pgym.book_class(class_id, f"Cliente {worker}-{i}", f"c{worker}-{i}@example.com")
+            except Exception as e:
+                outcome = type(e).__name__
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        pgym.db.session.remove()
+    return outcomes
+
+
+def test_parallel_bookings_never_overbook(ctx, race_summary):
+    classes = [make_class(title=f"Corso {n}", start=6 + n, capacity=CAPACITY) for n in range(SLOTS)]
+    class_ids = [c.id for c in classes]
+    ctx.db.session.remove()
+
+    t0 = perf_counter()
+    results = run_forked(_book_many, [(w, class_ids) for w in range(PROCESSES)])
+    elapsed = perf_counter() - t0
+
+    totals = {}
+    for r in results:
+        for outcome, n in r.items():
+            totals[outcome] = totals.get(outcome, 0) + n
+    attempts = PROCESSES * ATTEMPTS_PER_PROCESS
+    race_summary.append(f"{attempts} booking attempts from {PROCESSES} processes "
+                        f"(BOOKING_RETRIES={ctx.BOOKING_RETRIES}) in {elapsed:.2f}s, {attempts / elapsed:.0f}/s: {totals}")
+
+    booked = dict(ctx.db.session.query(ctx.Booking.class_id, func.count(ctx.Booking.id)).group_by(ctx.Booking.class_id))
+    for cs in ctx.ClassSession.query.all():
+        assert booked.get(cs.id, 0) <= cs.capacity
+        assert cs.booked_count == booked.get(cs.id, 0)
+    assert totals.get("ok", 0) == sum(booked.values())
+    assert set(totals) <= {"ok", "full"}
+    assert totals["ok"] == sum(c.capacity for c in classes)
+    assert ctx.booked_count_drift() == []
+
+
+def test_last_spot_goes_to_one_member(ctx):
+    cs = make_class(capacity=1)
+    assert ctx.book_class(cs.id, "Primo", "primo@example.com") == "ok"
+    assert ctx.book_class(cs.id, "Secondo", "secondo@example.com") == "full"
+    assert ctx.book_class(cs.id, "Primo", "primo@example.com") == "duplicate"
+    assert ctx.db.session.get(ctx.ClassSession, cs.id).booked_count == 1
@@ -0,0 +1,154 @@
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import make_class, pgym
+
+
+@pytest.fixture
+def class_id(client):
+    with pgym.app.app_context():
+        return make_class(day=date.today()).id
+
+
+def page_urls(class_id):
+    return ["/", "/calendar", f"/admin/classes/{class_id}"]
+
+
+def test_unchanged_pages_answer_304(client, class_id):
+    for url in page_urls(class_id):
+        resp = client.get(url)
+        assert resp.status_code == 200, url
+        assert resp.headers["ETag"] and resp.headers["Last-Modified"], url
+        again = client.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+        assert (again.status_code, again.data) == (304, b""), url
+        since = client.get(url, headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+        assert since.status_code == 304, url
+
+
+def test_pending_flash_forces_a_full_render(client, class_id):
+    etags = {url: client.get(url).headers["ETag"] for url in page_urls(class_id)}
+    for url, etag in etags.items():
+        with client.session_transaction() as s:
+            s["_flashes"] = [("info", "Messaggio in attesa")]
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200, url
+        assert "Messaggio in attesa" in resp.get_data(as_text=True), url
+
+
+def test_booking_changes_the_etag(client, class_id):
+    before = {url: client.get(url).headers["ETag"] for url in page_urls(class_id)}
+    resp = client.post(f"/book/{class_id}", data={"name": "Cliente", "email": "cliente@example.com"},
+                       follow_redirects=True)  # the redirect shows (and consumes) the flash
+    assert "Prenotazione effettuata!" in resp.get_data(as_text=True)
+    for url, etag in before.items():
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200, url
+        assert resp.headers["ETag"] != etag, url
+
+
+def test_member_login_changes_the_etag(client, class_id):
+    with pgym.app.app_context():
+        member = pgym.Member(name="Cliente")
+        pgym.db.session.add(member)
+        pgym.db.session.commit()
+        member_id = member.id
+    before = {url: client.get(url).headers["ETag"] for url in page_urls(class_id)}
+    with client.session_transaction() as s:
+        s["member_id"] = member_id
+    for url, etag in before.items():
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200, url
+        assert resp.headers["ETag"] != etag, url
+        assert "Cookie" in resp.headers["Vary"], url
+
+
+def test_availability_answers_304_until_a_booking(client, class_id):
+    resp = client.get("/api/availability")
+    assert resp.status_code == 200
+    assert [s["id"] for s in resp.get_json()["sessions"]] == [class_id]
+    etag = resp.headers["ETag"]
+    assert client.get("/api/availability", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/api/availability", headers={"If-Modified-Since": resp.headers["Last-Modified"]}).status_code == 304
+    with pgym.app.app_context():
+        assert pgym.book_class(class_id, "Cliente", "cliente@example.com") == "ok"
+        pgym.db.session.remove()
+    resp = client.get("/api/availability", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.get_json()["sessions"][0]["spots_left"] == 1
+
+
+@pytest.mark.parametrize("query", [
+    "from=2024-13-01", "to=domani", "from=2025-03-10&to=2025-03-09",
+    "from=2025-01-01&to=2026-01-03",  # 367 days, over API_MAX_RANGE_DAYS
+])
+def test_availability_rejects_bad_ranges(client, query):
+    resp = client.get(f"/api/availability?{query}")
+    assert resp.status_code == 400
+    assert "error" in resp.get_json()
+
+
+def test_availability_accepts_the_longest_range(client):
+    assert client.get("/api/availability?from=2025-01-01&to=2026-01-02").status_code == 200
+
+
+@pytest.mark.parametrize("url", ["/ics/coach/Anna.ics", "/ics/all.ics"])
+def test_session_feeds_answer_304_until_the_range_changes(client, class_id, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.get_data(as_text=True).count("BEGIN:VEVENT") == 1
+    etag = resp.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": resp.headers["Last-Modified"]}).status_code == 304
+    with pgym.app.app_context():
+        make_class(title="Yoga", start=18, coach="Anna")
+        make_class(title="Boxe", start=19, coach="Marco")
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.get_data(as_text=True).count("BEGIN:VEVENT") == (2 if "Anna" in url else 3)
+
+
+@pytest.mark.parametrize("url", ["/", "/calendar"])
+def test_current_week_pages_change_on_monday(client, class_id, fake_today, url):
+    next_monday = pgym.week_of(date.today()) + timedelta(days=7)
+    with pgym.app.app_context():
+        make_class(day=next_monday)
+        make_class(title="Yoga", day=date.today(), start=18)  # this week changed last
+    since = {"If-Modified-Since": client.get(url).headers["Last-Modified"]}
+    assert client.get(url, headers=since).status_code == 304
+    # same URL, next week's page: a client that only sends the date must not keep last week's
+    fake_today(next_monday)
+    assert client.get(url, headers=since).status_code == 200
+
+
+def test_explicit_week_keeps_its_last_modified(client, class_id, fake_today):
+    url = f"/calendar?week={pgym.week_of(date.today())}"
+    since = {"If-Modified-Since": client.get(url).headers["Last-Modified"]}
+    fake_today(pgym.week_of(date.today()) + timedelta(days=7))
+    assert client.get(url, headers=since).status_code == 304
+
+
+def test_default_availability_range_moves_at_midnight(client, class_id, fake_today):
+    with pgym.app.app_context():
+        make_class(title="Yoga", day=date.today() + timedelta(days=7))  # enters tomorrow's default range
+        make_class(title="Boxe", start=18)  # today's range changed last
+    since = {"If-Modified-Since": client.get("/api/availability").headers["Last-Modified"]}
+    assert client.get("/api/availability", headers=since).status_code == 304
+    fake_today(date.today() + timedelta(days=1))
+    assert client.get("/api/availability", headers=since).status_code == 200
+
+
+@pytest.mark.parametrize("url", ["/ics/coach/Anna.ics", "/ics/all.ics"])
+def test_default_feed_range_moves_at_midnight(client, class_id, fake_today, url):
+    with pgym.app.app_context():
+        make_class(title="Yoga", day=date.today() + timedelta(days=91))  # enters tomorrow's 90-day window
+        make_class(title="Boxe", start=18)
+    since = {"If-Modified-Since": client.get(url).headers["Last-Modified"]}
+    assert client.get(url, headers=since).status_code == 304
+    fake_today(date.today() + timedelta(days=1))
+    assert client.get(url, headers=since).status_code == 200
+    # an explicit range is the same data whatever the day
+    explicit = f"{url}?from={date.today()}&to={date.today() + timedelta(days=90)}"
+    since = {"If-Modified-Since": client.get(explicit).headers["Last-Modified"]}
+    fake_today(date.today() + timedelta(days=2))
+    assert client.get(explicit, headers=since).status_code == 304
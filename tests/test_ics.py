@@ -0,0 +1,60 @@
+from datetime import date, datetime, time, timedelta
+
+from werkzeug.http import http_date
+
+from conftest import make_class, pgym
+
+
+def member_with_booking(booked_days_ago=3):
+    member = pgym.Member(name="Cliente", calendar_token="feed-token")
+    pgym.db.session.add(member)
+    pgym.db.session.flush()
+    cs = make_class()
+    pgym.db.session.add(pgym.Booking(
+        member_id=member.id, class_id=cs.id, created_at=datetime.utcnow() - timedelta(days=booked_days_ago)))
+    pgym.db.session.commit()
+
+
+def test_member_feed_answers_304_until_the_day_changes(client):
+    with pgym.app.app_context():
+        member_with_booking()
+    url = "/ics/member/feed-token.ics"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert "BEGIN:VEVENT" in resp.get_data(as_text=True)
+    midnight = datetime.combine(date.today(), time())
+    assert resp.last_modified.replace(tzinfo=None) >= midnight  # not the booking time, days ago
+
+    assert client.get(url, headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": resp.headers["Last-Modified"]}).status_code == 304
+    yesterday = http_date(midnight - timedelta(seconds=1))
+    assert client.get(url, headers={"If-Modified-Since": yesterday}).status_code == 200
+
+
+def test_fold_keeps_multibyte_characters_whole():
+    line = "DESCRIPTION:" + "Prenotazione è confermata — però " * 6
+    folded = pgym.ics_fold(line)
+    physical = folded.split("\r\n")[:-1]
+    assert len(physical) > 1
+    assert all(len(p.encode("utf-8")) <= 75 for p in physical)
+    assert all(p.startswith(" ") for p in physical[1:])
+    assert "".join([physical[0]] + [p[1:] for p in physical[1:]]) == line
+    assert pgym.ics_fold("SUMMARY:Pilates") == "SUMMARY:Pilates\r\n"
+
+
+def test_escape_text_values():
+    assert pgym.ics_escape("a;b,c\\d") == r"a\;b\,c\\d"
+    assert pgym.ics_escape("riga 1\nriga 2\r\nriga 3") == r"riga 1\nriga 2\nriga 3"
+
+
+def test_member_feed_changes_with_the_member_name(client):
+    with pgym.app.app_context():
+        member_with_booking()
+    url = "/ics/member/feed-token.ics"
+    etag = client.get(url).headers["ETag"]
+    with pgym.app.app_context():
+        pgym.Member.query.one().name = "Cliente Rinominato"
+        pgym.db.session.commit()
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert "Cliente Rinominato" in resp.get_data(as_text=True)
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+from conftest import pgym, run_forked
+from querycount import count_queries
+
+
+def signed_payload(member_id=1, minutes=30, nonce="n1"):
+    return {"m": member_id, "e": int((datetime.utcnow() + timedelta(minutes=minutes)).timestamp()), "n": nonce}
+
+
+def _use_nonce(path, nonce, expires_ts):
+    return pgym.SqliteReplayFilter(path).first_use(nonce, expires_ts)
+
+
+def test_signed_link_logs_in_once(client, monkeypatch):
+    monkeypatch.setattr(pgym, "MAGIC_LINK_MODE", "signed")
+    monkeypatch.setattr(pgym, "replay_filter", pgym.ReplayFilter())
+    with pgym.app.app_context():
+        member = pgym.Member(name="Cliente")
+        pgym.db.session.add(member)
+        pgym.db.session.commit()
+        token = pgym.issue_magic_token(member.id)
+    assert "." in token
+    assert client.get(f"/m/{token}").headers["Location"].endswith("/me")
+
+    with count_queries() as statements:
+        resp = client.get(f"/m/{token}")
+    assert resp.headers["Location"].endswith("/login-magic")
+    assert statements == []
+    with client.session_transaction() as s:
+        assert "già stato usato" in str(s["_flashes"])
+
+
+def test_expired_and_tampered_tokens_are_rejected(monkeypatch):
+    monkeypatch.setattr(pgym, "replay_filter", pgym.ReplayFilter())
+    expired = pgym.magic_signer.dumps(signed_payload(minutes=-1))
+    assert pgym.verify_signed_token(expired) == (None, "Link scaduto. Richiedine uno nuovo.")
+
+    token = pgym.magic_signer.dumps(signed_payload(member_id=1))
+    body, sig = token.rsplit(".", 1)
+    forged = pgym.magic_signer.dumps(signed_payload(member_id=2)).rsplit(".", 1)[0] + "." + sig
+    tampered = body + "." + ("A" if sig[0] != "A" else "B") + sig[1:]
+    for bad in (forged, tampered):
+        assert pgym.verify_signed_token(bad) == (None, "Link non valido.")
+    assert pgym.verify_signed_token(token) == (1, None)  # the nonce was not burned by the failures
+
+
+def test_replay_filter_drops_expired_buckets():
+    replay = pgym.ReplayFilter()
+    now = int(datetime.utcnow().timestamp())
+    assert replay.first_use("old", now - 300)
+    assert replay.first_use("new", now + 600)
+    assert not replay.first_use("new", now + 600)
+    assert len(replay.buckets) == 1
+    assert all("old" not in seen for seen in replay.buckets.values())
+
+
+def test_sqlite_replay_filter_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "nonces.db")
+    expires = int((datetime.utcnow() + timedelta(minutes=30)).timestamp())
+    pgym.SqliteReplayFilter(path)
+    assert run_forked(_use_nonce, [(path, "n1", expires)]) == [True]
+    assert not pgym.SqliteReplayFilter(path).first_use("n1", expires)
+    assert pgym.SqliteReplayFilter(path).first_use("n2", expires)
+
+
+def test_purge_removes_expired_tokens_in_batches(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    now = datetime.utcnow()
+    past, future = now - timedelta(minutes=1), now + timedelta(minutes=30)
+    ctx.db.session.add_all(
+        [ctx.MagicToken(member_id=member.id, token=f"old{i}", expires_at=past, used=i % 2 == 0) for i in range(7)]
+        + [ctx.MagicToken(member_id=member.id, token="live", expires_at=future),
+           ctx.MagicToken(member_id=member.id, token="live-used", expires_at=future, used=True)])
+    ctx.db.session.commit()
+
+    batches = list(ctx.purge_magic_tokens(batch_size=3))
+
+    assert [removed for removed, _ in batches] == [3, 3, 1]
+    assert all(seconds >= 0 for _, seconds in batches)
+    assert {t.token for t in ctx.MagicToken.query} == {"live", "live-used"}
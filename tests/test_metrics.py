@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import pgym
+
+
+@pytest.fixture
+def metrics(client, monkeypatch):
+    monkeypatch.setattr(pgym, "request_metrics", pgym.RequestMetrics())
+    monkeypatch.delenv("METRICS_TOKEN", raising=False)
+    return client
+
+
+def scrape(client, **headers):
+    resp = client.get("/metrics", headers=headers)
+    assert resp.status_code == 200
+    return dict(line.rsplit(" ", 1) for line in resp.get_data(as_text=True).splitlines() if not line.startswith("#"))
+
+
+def test_metrics_count_requests_and_statements_per_endpoint(metrics):
+    for _ in range(2):
+        assert metrics.get("/api/next-available").status_code == 200
+    samples = scrape(metrics)
+    endpoint = '{endpoint="api_next_available"}'
+    assert samples[f"pgym_http_request_duration_seconds_count{endpoint}"] == "2"
+    assert samples['pgym_http_request_duration_seconds_bucket{endpoint="api_next_available",le="+Inf"}'] == "2"
+    assert samples['pgym_http_requests_total{endpoint="api_next_available",status="200"}'] == "2"
+    assert samples[f"pgym_sql_statements_total{endpoint}"] == "2"  # one statement per request
+    assert float(samples[f"pgym_sql_seconds_total{endpoint}"]) > 0
+
+
+def test_metrics_token_is_required_when_set(metrics, monkeypatch):
+    monkeypatch.setenv("METRICS_TOKEN", "s3cret")
+    assert metrics.get("/metrics").status_code == 403
+    assert metrics.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert "pgym_http_requests_total" in "".join(scrape(metrics, Authorization="Bearer s3cret"))
+
+
+def test_slow_requests_are_logged_with_their_sql(metrics, monkeypatch, caplog):
+    monkeypatch.setattr(pgym, "SLOW_REQUEST_MS", 0.001)
+    metrics.get("/api/next-available")
+    assert "slow request GET /api/next-available" in caplog.text
+    assert "1 SQL in" in caplog.text
+    assert "FROM class_session" in caplog.text
@@ -0,0 +1,36 @@
+from sqlalchemy import text
+
+from conftest import make_class
+
+
+def test_booked_count_is_backfilled_on_upgrade(ctx):
+    cs = make_class(capacity=2)
+    for i in range(2):
+        assert ctx.book_class(cs.id, f"Cliente {i}", f"c{i}@example.com") == "ok"
+    class_id = cs.id
+    # back to the schema before the counter existed
+    with ctx.db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_class_session_open"))
+        conn.execute(text("ALTER TABLE class_session DROP COLUMN booked_count"))
+    ctx.db.session.remove()
+    ctx.db.engine.dispose()  # a restart: no pooled connection remembers the old schema
+
+    ctx.migrate_db()
+
+    assert ctx.db.session.get(ctx.ClassSession, class_id).booked_count == 2
+    assert ctx.book_class(class_id, "Terzo", "terzo@example.com") == "full"
+
+
+def test_calendar_token_index_is_added_on_upgrade(ctx):
+    # back to the schema before the webcal feed: no column, no index
+    with ctx.db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_member_calendar_token"))
+        conn.execute(text("ALTER TABLE member DROP COLUMN calendar_token"))
+    ctx.db.session.remove()
+    ctx.db.engine.dispose()
+
+    ctx.migrate_db()
+
+    idx = {i["name"]: i for i in ctx.inspect(ctx.db.engine).get_indexes("member")}
+    assert idx["ix_member_calendar_token"]["unique"]
+    assert not any(ctx.is_full_scan(line) for line in ctx.explain(ctx.Member.query.filter_by(calendar_token="x")))
@@ -0,0 +1,59 @@
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import make_class, pgym
+
+DAY1 = date.today() + timedelta(days=1)
+DAY2 = date.today() + timedelta(days=2)
+
+
+@pytest.fixture
+def slots(client):
+    # created out of order; the 08:00 of DAY1 is full
+    with pgym.app.app_context():
+        ids = {
+            (DAY2, 9): make_class("Personal", DAY2, 9, capacity=1, coach="Marco").id,
+            (DAY1, 12): make_class("Personal", DAY1, 12, capacity=1, coach="Marco").id,
+            (DAY2, 8): make_class("Personal", DAY2, 8, capacity=1).id,
+            (DAY1, 10): make_class("Personal", DAY1, 10, capacity=1).id,
+            (DAY1, 8): make_class("Personal", DAY1, 8, capacity=1).id,
+            "pilates": make_class("Pilates", DAY1, 11).id,
+        }
+        pgym.db.session.get(pgym.ClassSession, ids[(DAY1, 8)]).booked_count = 1
+        pgym.db.session.commit()
+    return ids
+
+
+def found(client, **args):
+    resp = client.get("/api/next-available", query_string=args)
+    assert resp.status_code == 200
+    return [s["id"] for s in resp.get_json()["slots"]]
+
+
+def test_open_slots_in_date_and_time_order(client, slots):
+    assert found(client, after=f"{DAY1}T07:00") == [slots[(DAY1, 10)], slots[(DAY1, 12)], slots[(DAY2, 8)], slots[(DAY2, 9)]]
+
+
+def test_after_boundary_within_a_day_and_across_days(client, slots):
+    assert found(client, after=f"{DAY1}T10:00")[0] == slots[(DAY1, 10)]  # a slot starting at `after` counts
+    assert found(client, after=f"{DAY1}T10:01") == [slots[(DAY1, 12)], slots[(DAY2, 8)], slots[(DAY2, 9)]]
+    assert found(client, after=f"{DAY1}T13:00") == [slots[(DAY2, 8)], slots[(DAY2, 9)]]
+    assert found(client, after=f"{DAY2}T08:30") == [slots[(DAY2, 9)]]
+
+
+def test_coach_and_type_filters(client, slots):
+    assert found(client, after=f"{DAY1}T07:00", coach="Marco") == [slots[(DAY1, 12)], slots[(DAY2, 9)]]
+    assert found(client, after=f"{DAY1}T07:00", type="Pilates") == [slots["pilates"]]
+    assert found(client, after=f"{DAY1}T07:00", type="Pilates", coach="Marco") == []
+
+
+def test_n_is_clamped(client, slots, monkeypatch):
+    assert len(found(client, after=f"{DAY1}T07:00", n=2)) == 2
+    assert len(found(client, after=f"{DAY1}T07:00", n=0)) == 1
+    asked = []
+    monkeypatch.setattr(pgym, "next_available", lambda after, title, coach, n: asked.append(n) or [])
+    found(client, n=1000)
+    assert asked == [50]
+    assert client.get("/api/next-available?n=tanti").status_code == 400
+    assert client.get("/api/next-available?after=domani").status_code == 400
@@ -0,0 +1,36 @@
+from datetime import date, time, timedelta
+
+import pytest
+
+from conftest import make_class, pgym
+
+
+@pytest.fixture
+def strict(monkeypatch):
+    monkeypatch.setattr(pgym, "NPLUSONE", "raise")
+
+
+def test_booking_with_detector_raising(client, strict):
+    with pgym.app.app_context():
+        class_id = make_class(capacity=2).id
+    resp = client.post(f"/book/{class_id}", data={"name": "Cliente", "email": "cliente@example.com"})
+    assert resp.status_code == 302
+    with pgym.app.app_context():
+        assert pgym.db.session.get(pgym.ClassSession, class_id).booked_count == 1
+
+
+def test_orm_writes_outside_requests(ctx, strict):
+    ctx.db.session.add(ctx.ClassSession(title="Yoga", date=date.today() + timedelta(days=1),
+                                        start_time=time(9), end_time=time(10), capacity=2))
+    ctx.db.session.commit()
+    assert ctx.upsert_personal_slots() > 0
+
+
+def test_lazy_loads_in_a_loop_are_reported(client, strict):
+    with pgym.app.app_context():
+        for i in range(3):
+            cs = make_class(title=f"Corso {i}", start=9 + i)
+            pgym.book_class(cs.id, f"Cliente {i}", f"c{i}@example.com")
+
+    with pgym.app.test_request_context("/"), pytest.raises(pgym.NPlusOneError):
+        [b.class_session.title for b in pgym.Booking.query.all()]
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+from time import monotonic
+
+from conftest import pgym
+
+
+def queue_messages(n):
+    for i in range(n):
+        assert pgym.enqueue_whatsapp_text(f"+39333000000{i}", f"messaggio {i}")
+    pgym.db.session.commit()
+
+
+def test_drain_sends_queued_messages(ctx, graph_api):
+    queue_messages(5)
+    assert ctx.drain_outbox(batch_size=50, concurrency=4) == (5, 5)
+    assert sorted(r["text"]["body"] for r in graph_api.received) == [f"messaggio {i}" for i in range(5)]
+    assert {m.status for m in ctx.OutboxMessage.query} == {"sent"}
+    assert ctx.drain_outbox() == (0, 0)
+
+
+def test_failed_send_is_retried_with_backoff(ctx, graph_api):
+    graph_api.replies = [(500, {})]
+    queue_messages(1)
+    assert ctx.drain_outbox() == (1, 0)
+    m = ctx.OutboxMessage.query.one()
+    assert (m.status, m.attempts) == ("pending", 1)
+    assert m.last_error.startswith("500")
+    assert m.next_attempt_at > datetime.utcnow()
+    assert ctx.drain_outbox() == (0, 0)  # not due yet
+
+    m.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+    ctx.db.session.commit()
+    assert ctx.drain_outbox() == (1, 1)
+    assert ctx.db.session.get(ctx.OutboxMessage, m.id).status == "sent"
+    assert len(graph_api.received) == 2
+
+
+def test_magic_link_is_queued_not_sent_inline(client, graph_api, monkeypatch):
+    monkeypatch.setattr(pgym, "WHATSAPP_OUTBOX", True)
+    resp = client.post("/login-magic", data={"phone": "+393330000000"})
+    assert resp.status_code == 302
+    assert graph_api.received == []
+
+    with pgym.app.app_context():
+        assert pgym.drain_outbox() == (1, 1)
+    assert "/m/" in graph_api.received[0]["text"]["body"]
+
+
+def test_open_circuit_does_not_use_up_attempts(ctx, graph_api, monkeypatch):
+    monkeypatch.setattr(ctx, "OUTBOX_MAX_ATTEMPTS", 2)
+    queue_messages(1)
+    ctx.whatsapp_breaker.state, ctx.whatsapp_breaker.opened_at = "open", monotonic()
+    for _ in range(5):  # an outage longer than the message's tries
+        assert ctx.drain_outbox() == (1, 0)
+        m = ctx.OutboxMessage.query.one()
+        assert (m.status, m.attempts) == ("pending", 0)
+        assert m.next_attempt_at > datetime.utcnow()
+        m.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        ctx.db.session.commit()
+    assert graph_api.received == []
+
+    ctx.whatsapp_breaker.record_success()
+    assert ctx.drain_outbox() == (1, 1)
+    assert ctx.OutboxMessage.query.one().status == "sent"
@@ -0,0 +1,219 @@
+from datetime import datetime, timedelta
+from time import sleep
+
+from sqlalchemy import event, func
+
+from conftest import make_class, pgym, run_forked
+
+PROCESSES = 4
+CLASSES_PER_PROCESS = 4
+ENTRIES = 5
+
+
+def ledger_sum(member_id):
+    return pgym.db.session.query(func.coalesce(func.sum(pgym.PackageLedger.delta), 0))\
+        .filter_by(member_id=member_id).scalar()
+
+
+def _book_all(class_ids):
+    pgym.BOOKING_RETRIES = 12
+    pgym.REQUIRE_PACKAGE = True
+    outcomes = {}
+    with pgym.app.app_context():
+        for class_id in class_ids:
+            outcome = pgym.book_class(class_id, "Cliente", "cliente@example.com")
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        pgym.db.session.remove()
+    return outcomes
+
+
+def test_parallel_bookings_never_overdraw_the_package(ctx):
+    member = ctx.Member(name="Cliente", email="cliente@example.com")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    ctx.db.session.add(ctx.Package(member_id=member.id, total=ENTRIES, remaining=ENTRIES))
+    ctx.db.session.commit()
+    member_id = member.id
+    class_ids = [make_class(title=f"Corso {n}", start=6 + n).id for n in range(PROCESSES * CLASSES_PER_PROCESS)]
+    ctx.db.session.remove()
+
+    chunks = [(class_ids[w::PROCESSES],) for w in range(PROCESSES)]
+    totals = {}
+    for r in run_forked(_book_all, chunks):
+        for outcome, n in r.items():
+            totals[outcome] = totals.get(outcome, 0) + n
+
+    assert totals == {"ok": ENTRIES, "no_entries": len(class_ids) - ENTRIES}
+    assert ctx.Package.query.one().remaining == 0
+    assert ctx.member_remaining_entries(member_id) == 0
+    assert ledger_sum(member_id) == 0
+    assert ctx.Booking.query.count() == ENTRIES
+
+
+def test_upgrade_opens_packages_already_debited(ctx):
+    # a package sold before the ledger existed, then a booking debited after the upgrade
+    member = ctx.Member(name="Cliente", email="cliente@example.com")
+    ctx.db.session.add(member)
+    ctx.db.session.commit()
+    ctx.db.session.execute(ctx.Package.__table__.insert().values(
+        member_id=member.id, total=8, remaining=8, activated_at=datetime.utcnow()))
+    ctx.db.session.commit()
+    cs = make_class()
+    assert ctx.book_class(cs.id, "Cliente", "cliente@example.com") == "ok"
+
+    ctx.migrate_db()
+
+    assert ctx.Package.query.one().remaining == 7
+    assert ctx.member_remaining_entries(member.id) == 7
+    assert ledger_sum(member.id) == 7
+    ctx.migrate_db()  # already opened: nothing more to add
+    assert ledger_sum(member.id) == 7
+
+
+def test_rebuild_keeps_drift_visible(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.commit()
+    ctx.apply_ledger([dict(member_id=member.id, delta=-2, reason="booking")])
+    ctx.db.session.commit()
+    ctx.rebuild_balances()
+    assert ctx.member_remaining_entries(member.id) == -2
+
+
+def test_expired_packages_do_not_count_before_the_sweep(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.commit()
+    yesterday = datetime.utcnow() - timedelta(days=1)
+    ctx.db.session.add_all([
+        ctx.Package(member_id=member.id, total=10, remaining=4, expires_at=yesterday),
+        ctx.Package(member_id=member.id, total=5, remaining=5),
+    ])
+    ctx.db.session.commit()
+    assert ctx.member_remaining_entries(member.id) == 5
+    assert ctx.expire_packages() == 1
+    assert ctx.member_remaining_entries(member.id) == 5
+
+
+def test_opening_rows_are_written_once(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.commit()
+    ctx.db.session.execute(ctx.Package.__table__.insert().values(member_id=member.id, total=8, remaining=8))
+    ctx.db.session.commit()
+    package_id = ctx.Package.query.one().id
+    # a second process that read the same untracked package before this one committed
+    opening = dict(member_id=member.id, package_id=package_id, delta=8, reason="opening", created_at=datetime.utcnow())
+    ctx.rebuild_balances()
+    ctx.insert_ignore(ctx.PackageLedger, [opening])
+    ctx.db.session.commit()
+    ctx.rebuild_balances()
+    assert ctx.PackageLedger.query.filter_by(package_id=package_id).count() == 1
+    assert ctx.member_remaining_entries(member.id) == 8
+
+
+def _sweep_or_book(job, package_id, member_id):
+    with pgym.app.app_context():
+        if job == "sweep":
+            def linger(conn, cursor, statement, *args):
+                if statement.lstrip().upper().startswith("SELECT") and "package.expires_at <" in statement:
+                    sleep(0.5)  # a booking lands between the batch read and the update, unless it has to wait
+            event.listen(pgym.db.engine, "after_cursor_execute", linger)
+            pgym.expire_packages()
+        else:
+            # the tail of consume_entry() for a package picked just before it expired
+            sleep(0.2)
+            pt = pgym.Package.__table__
+            res = pgym.db.session.execute(pgym.update(pt).where(pt.c.id == package_id, pt.c.remaining > 0)
+                                          .values(remaining=pt.c.remaining - 1))
+            if res.rowcount == 1:
+                pgym.apply_ledger([dict(member_id=member_id, package_id=package_id, delta=-1, reason="booking")])
+            pgym.db.session.commit()
+        pgym.db.session.remove()
+
+
+def test_sweep_debits_what_it_zeroed_despite_a_concurrent_booking(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    ctx.db.session.add(ctx.Package(member_id=member.id, total=3, remaining=3,
+                                   expires_at=datetime.utcnow() - timedelta(minutes=1)))
+    ctx.db.session.commit()
+    member_id, package_id = member.id, ctx.Package.query.one().id
+    ctx.db.session.remove()
+
+    run_forked(_sweep_or_book, [("sweep", package_id, member_id), ("book", package_id, member_id)])
+
+    assert ctx.Package.query.one().remaining == 0
+    assert ledger_sum(member_id) == 0
+    assert ctx.member_remaining_entries(member_id) == 0
+
+
+def test_only_an_identified_member_spends_entries(client, monkeypatch):
+    monkeypatch.setattr(pgym, "REQUIRE_PACKAGE", True)
+    with pgym.app.app_context():
+        member = pgym.Member(name="Mario Rossi", email="mario@example.com")
+        pgym.db.session.add(member)
+        pgym.db.session.flush()
+        pgym.db.session.add(pgym.Package(member_id=member.id, total=5, remaining=5))
+        pgym.db.session.commit()
+        member_id = member.id
+        class_ids = [make_class(title=f"Corso {n}", start=8 + n).id for n in range(3)]
+
+        # same name, an email nobody has: the booking is not paid with Mario's entries
+        assert pgym.book_class(class_ids[0], "Mario Rossi", "altro@example.com") == "no_entries"
+        assert pgym.book_class(class_ids[0], "Mario Rossi") == "no_entries"
+        assert pgym.book_class(class_ids[0], "Mario Rossi", "mario@example.com") == "ok"
+        assert pgym.member_remaining_entries(member_id) == 4
+        pgym.db.session.remove()
+
+    with client.session_transaction() as s:
+        s["member_id"] = member_id
+    client.post(f"/book/{class_ids[1]}", data={"name": "Mario Rossi"})
+    with pgym.app.app_context():
+        assert pgym.Booking.query.filter_by(member_id=member_id).count() == 2
+        assert pgym.member_remaining_entries(member_id) == 3
+        assert ledger_sum(member_id) == 3
+
+
+def _rebuild_or_book(job, class_id):
+    with pgym.app.app_context():
+        if job == "rebuild":
+            def linger(conn, cursor, statement, *args):
+                if "sum(package_ledger.delta)" in statement.lower():
+                    sleep(0.5)  # a booking lands between the sum and the rewrite, unless it has to wait
+            event.listen(pgym.db.engine, "after_cursor_execute", linger)
+            pgym.rebuild_balances()
+        else:
+            sleep(0.2)
+            assert pgym.book_class(class_id, "Cliente", "cliente@example.com") == "ok"
+        pgym.db.session.remove()
+
+
+def test_rebuild_does_not_lose_a_concurrent_booking(ctx):
+    member = ctx.Member(name="Cliente", email="cliente@example.com")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    ctx.db.session.add(ctx.Package(member_id=member.id, total=8, remaining=8))
+    ctx.db.session.commit()
+    member_id, class_id = member.id, make_class().id
+    ctx.db.session.remove()
+
+    run_forked(_rebuild_or_book, [("rebuild", class_id), ("book", class_id)])
+
+    assert ledger_sum(member_id) == 7
+    assert ctx.member_remaining_entries(member_id) == 7
+
+
+def test_startup_rebuild_skips_packages_already_opened(ctx):
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.commit()
+    ctx.db.session.execute(ctx.Package.__table__.insert().values(member_id=member.id, total=8, remaining=8))
+    ctx.db.session.commit()
+    assert ctx.rebuild_balances(only_if_untracked=True) == 1
+    # the next worker to boot finds nothing to open and leaves the live balances alone
+    ctx.db.session.execute(ctx.update(ctx.MemberBalance.__table__).values(balance=5))
+    ctx.db.session.commit()
+    assert ctx.rebuild_balances(only_if_untracked=True) == 0
+    assert ctx.member_remaining_entries(member.id) == 5
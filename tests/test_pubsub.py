@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from conftest import make_class
+
+
+def test_bookings_publish_nothing_when_live_is_off(ctx, monkeypatch):
+    published = []
+    monkeypatch.setattr(ctx.pubsub, "publish", published.append)
+    cs = make_class(capacity=5)
+    for i in range(5):
+        assert ctx.book_class(cs.id, f"Cliente {i}", f"c{i}@example.com") == "ok"
+    assert published == []
+    assert ctx.AvailabilityEvent.query.count() == 0
+
+
+def test_bookings_publish_spots_left_when_live(ctx, monkeypatch):
+    published = []
+    monkeypatch.setattr(ctx, "LIVE_AVAILABILITY", True)
+    monkeypatch.setattr(ctx.pubsub, "publish", published.append)
+    cs = make_class(capacity=2)
+    assert ctx.book_class(cs.id, "Cliente", "cliente@example.com") == "ok"
+    [(topic, payload)] = published[0]
+    assert topic == ctx.week_of(cs.date).isoformat()
+    assert (payload["id"], payload["spots_left"]) == (cs.id, 1)
+
+
+def test_database_backend_prunes_on_publish(ctx):
+    ctx.db.session.add(ctx.AvailabilityEvent(topic="2026-01-05", payload="{}",
+                                             created_at=datetime.utcnow() - timedelta(hours=1)))
+    ctx.db.session.commit()
+    ctx.DatabasePubSub(keep_minutes=10).publish([("2026-10-12", {"id": 1, "spots_left": 0})])
+    assert [e.topic for e in ctx.AvailabilityEvent.query] == ["2026-10-12"]
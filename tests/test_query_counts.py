@@ -0,0 +1,59 @@
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import make_class, pgym
+from querycount import count_queries
+
+
+def seed(n):
+    # n classes over the coming week, each with one booking; returns the first class id
+    with pgym.app.app_context():
+        ids = []
+        for i in range(n):
+            cs = make_class(title=f"Corso {i}", day=date.today() + timedelta(days=i % 7), start=8 + i % 10)
+            ids.append(cs.id)
+            assert pgym.book_class(cs.id, f"Cliente {i}", f"c{i}@example.com") == "ok"
+        return ids[0]
+
+
+def queries(client, url):
+    with count_queries() as statements:
+        resp = client.get(url)
+        resp.get_data()  # streamed bodies run their queries here
+    assert resp.status_code == 200, url
+    return len(statements)
+
+
+# (url, statements on a cold cache, statements once the cache is warm)
+ROUTES = [
+    ("/", 2, 1),
+    ("/calendar", 2, 1),
+    ("/ics/all.ics", 2, 1),
+    ("/api/availability", 2, 2),
+    ("/api/next-available", 1, 1),
+]
+
+
+@pytest.mark.parametrize("n", [1, 30])
+@pytest.mark.parametrize("url,cold,warm", ROUTES)
+def test_route_query_count_is_fixed(client, n, url, cold, warm):
+    seed(n)
+    assert queries(client, url) == cold
+    assert queries(client, url) == warm
+
+
+@pytest.mark.parametrize("n", [1, 30])
+def test_class_pages_query_count_is_fixed(client, n):
+    class_id = seed(n)
+    assert queries(client, f"/admin/classes/{class_id}") == 2
+    assert queries(client, f"/book/{class_id}") == 1
+
+
+@pytest.mark.parametrize("n", [1, 30])
+def test_profile_query_count_is_fixed(client, n):
+    seed(n)
+    with client.session_transaction() as s:
+        s["member_id"] = 1
+    queries(client, "/me")  # first visit also issues the calendar token
+    assert queries(client, "/me") == 3
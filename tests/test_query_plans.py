@@ -0,0 +1,55 @@
+from datetime import date, datetime, time, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from conftest import pgym, reset_state
+
+MEMBERS = 2000
+DAYS = 365
+SLOTS_PER_DAY = 12
+BOOKINGS = 20000
+
+with pgym.app.app_context():
+    HOT_QUERIES = list(pgym.hot_queries())
+
+
+def seed():
+    # a year of sessions, a few thousand members with bookings, packages and tokens, then fresh statistics
+    today, now = date.today(), datetime.utcnow()
+    with pgym.app.app_context():
+        t = lambda model: model.__table__
+        pgym.db.session.execute(t(pgym.Member).insert(), [
+            dict(name=f"Cliente {i}", email=f"c{i}@example.com", phone=f"+39333{i:07d}") for i in range(MEMBERS)])
+        pgym.db.session.execute(t(pgym.ClassSession).insert(), [
+            dict(title="Personal" if h % 2 else "Pilates", coach="Anna", date=today + timedelta(days=d - 30),
+                 start_time=time(8 + h), end_time=time(9 + h), capacity=2, booked_count=2 if d % 3 else 0,
+                 location=pgym.DEFAULT_LOCATION)
+            for d in range(DAYS) for h in range(SLOTS_PER_DAY)])
+        sessions = DAYS * SLOTS_PER_DAY
+        pgym.db.session.execute(t(pgym.Booking).insert(), [
+            dict(member_id=1 + i % MEMBERS, class_id=1 + (i * 7919) % sessions, created_at=now - timedelta(minutes=i))
+            for i in range(BOOKINGS)])
+        pgym.db.session.execute(t(pgym.Package).insert(), [
+            dict(member_id=1 + i, total=8, remaining=4, activated_at=now - timedelta(days=i % 90))
+            for i in range(MEMBERS)])
+        pgym.db.session.execute(t(pgym.MagicToken).insert(), [
+            dict(member_id=1 + i, token=f"token-{i}", expires_at=now + timedelta(minutes=15)) for i in range(MEMBERS)])
+        pgym.db.session.commit()
+        pgym.db.session.execute(text("ANALYZE"))
+        pgym.db.session.commit()
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    reset_state()
+    seed()
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_an_index(seeded, name):
+    # runs on whatever TEST_DATABASE_URL points at, SQLite by default
+    with pgym.app.app_context():
+        plan = pgym.explain(pgym.hot_queries()[name])
+    assert plan
+    assert not [line for line in plan if pgym.is_full_scan(line)], "\n".join(plan)
@@ -0,0 +1,134 @@
+from datetime import date, datetime, time, timedelta
+from time import sleep
+
+from sqlalchemy import update
+
+from conftest import make_class, pgym, run_forked
+
+
+def age(ctx, model, minutes):
+    ctx.db.session.execute(update(model).values(created_at=datetime.utcnow() - timedelta(minutes=minutes)))
+    ctx.db.session.commit()
+
+
+def test_rollups_wait_for_rows_to_settle(ctx, monkeypatch):
+    monkeypatch.setattr(ctx, "ROLLUP_LAG_MINUTES", 10)
+    day = date.today() + timedelta(days=1)
+    for i in range(2):
+        cs = make_class(title="Pilates", day=day, start=9 + i, capacity=4)
+        assert ctx.book_class(cs.id, f"Cliente {i}", f"c{i}@example.com") == "ok"
+
+    # rows younger than the lag may sit next to lower ids still being committed: not folded yet
+    assert ctx.run_rollups() == {"package_purchase": 0, "class_session": 0, "booking": 0}
+    assert ctx.UsageRollup.query.count() == 0
+
+    age(ctx, ctx.ClassSession, 11)
+    age(ctx, ctx.Booking, 11)
+    assert ctx.run_rollups() == {"package_purchase": 0, "class_session": 2, "booking": 2}
+    usage = {u.start_time.hour: (u.sessions, u.capacity, u.booked) for u in ctx.UsageRollup.query}
+    assert usage == {9: (1, 4, 1), 10: (1, 4, 1)}
+
+    assert ctx.run_rollups() == {"package_purchase": 0, "class_session": 0, "booking": 0}
+
+
+def test_revenue_rollup_counts_backdated_purchases_once(ctx, monkeypatch):
+    monkeypatch.setattr(ctx, "ROLLUP_LAG_MINUTES", 0)
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    last_month = datetime.utcnow() - timedelta(days=30)
+    ctx.db.session.add_all([
+        ctx.PackagePurchase(member_id=member.id, package_size=8, price=80, purchased_at=last_month),
+        ctx.PackagePurchase(member_id=member.id, package_size=8, price=80),
+    ])
+    ctx.db.session.commit()
+    ctx.run_rollups()
+    ctx.run_rollups()
+    rows = {(r.day, r.package_size): (r.sold, r.revenue) for r in ctx.RevenueRollup.query}
+    assert rows == {(last_month.date(), 8): (1, 80), (date.today(), 8): (1, 80)}
+
+
+def test_swept_slots_leave_the_usage_rollup(ctx, monkeypatch):
+    monkeypatch.setattr(ctx, "ROLLUP_LAG_MINUTES", 0)
+    saturday = date.today() + timedelta(days=(5 - date.today().weekday()) % 7 or 7)
+    ctx.upsert_personal_slots()
+    slot = ctx.ClassSession.query.filter_by(title="Personal", date=saturday, start_time=time(17)).one()
+    assert ctx.book_class(slot.id, "Cliente", "cliente@example.com") == "ok"
+    ctx.run_rollups()
+    before = {u.start_time.hour: (u.sessions, u.booked) for u in ctx.UsageRollup.query.filter_by(day=saturday)}
+    assert before == {9: (1, 0), 10: (1, 0), 16: (1, 0), 17: (1, 1), 18: (1, 0)}
+    ctx.db.session.remove()
+
+    result = ctx.app.test_cli_runner().invoke(args=["schedule-set", "5", "09:00-11:00"])
+    assert result.exit_code == 0, result.output
+
+    after = {u.start_time.hour: (u.sessions, u.booked) for u in ctx.UsageRollup.query.filter_by(day=saturday)}
+    assert after == {9: (1, 0), 10: (1, 0), 17: (1, 1)}  # the booked slot stays
+    assert ctx.run_rollups()["class_session"] == 0
+
+
+def log_in(client, role):
+    with pgym.app.app_context():
+        user = pgym.User(name=role, email=f"{role}@example.com", role=role)
+        user.set_password("pw")
+        pgym.db.session.add(user)
+        pgym.db.session.commit()
+    client.post("/login", data={"email": f"{role}@example.com", "password": "pw"})
+
+
+def test_report_is_admin_only(client):
+    assert "/login" in client.get("/admin/reports").headers["Location"]
+    log_in(client, "coach")
+    resp = client.get("/admin/reports")
+    assert resp.status_code == 302
+    assert resp.headers["Location"].endswith("/")
+
+
+def test_report_renders_from_the_rollup_tables_alone(client):
+    recent, old = date.today() - timedelta(days=200), date.today() - timedelta(days=400)
+    with pgym.app.app_context():
+        # no purchases, sessions or bookings behind them: the page reads the rollups only
+        pgym.db.session.add_all([
+            pgym.RevenueRollup(day=recent, package_size=8, sold=3, revenue=240),
+            pgym.RevenueRollup(day=old, package_size=16, sold=1, revenue=150),
+            pgym.UsageRollup(day=recent, title="Pilates", coach="Anna", start_time=time(9), sessions=2, capacity=10, booked=4),
+        ])
+        pgym.db.session.commit()
+    log_in(client, "admin")
+
+    page = client.get("/admin/reports").get_data(as_text=True)  # default: the last 365 days
+    assert f"{date.today() - timedelta(days=365):%d/%m/%Y} — {date.today():%d/%m/%Y}" in page
+    assert recent.strftime("%Y-%m") in page and "€ 240.00" in page
+    assert "€ 150.00" not in page
+    assert "<td>Anna</td><td>4</td><td>10</td><td>40.0</td>" in page
+
+    page = client.get(f"/admin/reports?from={old}&to={old}").get_data(as_text=True)
+    assert "€ 150.00" in page and "€ 240.00" not in page
+
+
+def _rollup():
+    with pgym.app.app_context():
+        pgym.run_rollups()
+        pgym.db.session.remove()
+
+
+def test_overlapping_runs_fold_each_row_once(ctx, monkeypatch):
+    monkeypatch.setattr(ctx, "ROLLUP_LAG_MINUTES", 0)
+    ctx.run_rollups()  # the watermark rows exist
+    member = ctx.Member(name="Cliente")
+    ctx.db.session.add(member)
+    ctx.db.session.flush()
+    ctx.db.session.add(ctx.PackagePurchase(member_id=member.id, package_size=8, price=80))
+    ctx.db.session.commit()
+    ctx.db.session.remove()
+    settled_max_id = ctx.settled_max_id
+
+    def slow_settled_max_id(*args):
+        sleep(0.2)  # both runs are past their watermark read before either commits, unless they take turns
+        return settled_max_id(*args)
+
+    monkeypatch.setattr(ctx, "settled_max_id", slow_settled_max_id)
+    run_forked(_rollup, [(), ()])
+
+    rows = [(r.sold, r.revenue) for r in ctx.RevenueRollup.query]
+    assert rows == [(1, 80)]
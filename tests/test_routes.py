@@ -0,0 +1,91 @@
+from datetime import date, time, timedelta
+
+import pytest
+
+from conftest import make_class, pgym
+
+
+def test_malformed_personal_slot_url_is_404(client):
+    day = (date.today() + timedelta(days=1)).isoformat()
+    assert client.get(f"/book/personal/{day}/25:00").status_code == 404
+    assert client.get("/book/personal/2026-13-40/09:00").status_code == 404
+    assert client.post(f"/book/personal/{day}/nove").status_code == 404
+
+
+def test_slot_outside_the_schedule_redirects(client):
+    far = (date.today() + timedelta(days=400)).isoformat()
+    assert client.get(f"/book/personal/{far}/09:00").status_code == 302
+
+
+def test_live_stream_is_off_by_default(client):
+    assert "EventSource" not in client.get("/calendar").get_data(as_text=True)
+    assert client.get("/api/availability/stream").status_code == 204
+
+
+def test_live_stream_when_enabled(client, monkeypatch):
+    monkeypatch.setattr(pgym, "LIVE_AVAILABILITY", True)
+    monkeypatch.setattr(pgym, "SSE_MAX_SECONDS", 0)
+    assert "EventSource" in client.get("/calendar").get_data(as_text=True)
+    resp = client.get("/api/availability/stream")
+    assert resp.mimetype == "text/event-stream"
+    assert resp.get_data(as_text=True) == "retry: 3000\n\n"
+
+
+def next_monday():
+    return date.today() + timedelta(days=7 - date.today().weekday())
+
+
+@pytest.fixture
+def virtual_week(client, monkeypatch):
+    # next Monday with one real class at 09:00 and the Personal schedule still unstored
+    monkeypatch.setattr(pgym, "VIRTUAL_SLOTS", True)
+    monday = next_monday()
+    with pgym.app.app_context():
+        pilates_id = make_class(day=monday, start=9).id
+        schedule = [s for s, _, _ in pgym.slot_ranges_for_personal(monday)]
+    return monday, pilates_id, schedule
+
+
+def test_week_grid_merges_real_and_virtual_slots(client, virtual_week):
+    monday, pilates_id, schedule = virtual_week
+    page = client.get(f"/calendar?week={monday.isoformat()}").get_data(as_text=True)
+    assert f"/book/{pilates_id}" in page
+    for start in schedule:
+        assert f"/book/personal/{monday.isoformat()}/{start:%H:%M}" in page
+    with pgym.app.app_context():
+        assert pgym.ClassSession.query.filter_by(title="Personal").count() == 0
+
+
+def test_first_booking_materializes_the_slot(client, virtual_week):
+    monday = virtual_week[0]
+    url = f"/book/personal/{monday.isoformat()}/08:00"
+    assert client.post(url, data={"name": "Primo", "email": "primo@example.com"}).status_code == 302
+    with pgym.app.app_context():
+        slot = pgym.ClassSession.query.filter_by(title="Personal").one()
+        assert (slot.date, slot.start_time, slot.booked_count) == (monday, time(8), 1)
+        slot_id = slot.id
+
+    # the slot has its row now: a second booker is sent to the ordinary booking page
+    resp = client.post(url, data={"name": "Secondo", "email": "secondo@example.com"})
+    assert resp.status_code == 307
+    assert resp.headers["Location"].endswith(f"/book/{slot_id}")
+    with pgym.app.app_context():
+        assert pgym.ClassSession.query.filter_by(title="Personal").count() == 1
+        assert pgym.Booking.query.count() == 1
+
+
+def test_apis_list_real_and_virtual_slots(client, virtual_week):
+    monday, pilates_id, schedule = virtual_week
+    client.post(f"/book/personal/{monday.isoformat()}/08:00", data={"name": "Primo", "email": "primo@example.com"})
+    with pgym.app.app_context():
+        slot_id = pgym.ClassSession.query.filter_by(title="Personal").one().id
+
+    sessions = client.get(f"/api/availability?from={monday}&to={monday}").get_json()["sessions"]
+    by_start = {(s["title"], s["start"][-5:]): s for s in sessions}
+    assert len(sessions) == len(schedule) + 1
+    assert by_start[("Pilates", "09:00")]["id"] == pilates_id
+    assert (by_start[("Personal", "08:00")]["id"], by_start[("Personal", "08:00")]["spots_left"]) == (slot_id, 1)
+    assert by_start[("Personal", "09:00")]["id"] is None
+
+    slots = client.get(f"/api/next-available?after={monday}T07:00&n=3").get_json()["slots"]
+    assert [(s["id"], s["start"][-5:]) for s in slots] == [(slot_id, "08:00"), (None, "09:00"), (None, "10:00")]
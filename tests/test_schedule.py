@@ -0,0 +1,65 @@
+from datetime import date, time, timedelta
+
+from conftest import pgym
+
+
+def saturday_slots(day):
+    return {s.start_time: s for s in pgym.ClassSession.query.filter_by(title="Personal", date=day)}
+
+
+def test_closing_a_block_removes_unbooked_slots(ctx):
+    saturday = date.today() + timedelta(days=(5 - date.today().weekday()) % 7)
+    ctx.upsert_personal_slots()
+    slots = saturday_slots(saturday)
+    assert {time(16), time(17), time(18)} <= set(slots)
+    assert ctx.book_class(slots[time(17)].id, "Cliente", "cliente@example.com") == "ok"
+    ctx.db.session.remove()
+
+    result = ctx.app.test_cli_runner().invoke(args=["schedule-set", "5", "09:00-11:00"])
+    assert result.exit_code == 0, result.output
+
+    slots = saturday_slots(saturday)
+    assert set(slots) == {time(9), time(10), time(17)}  # the booked slot stays
+    assert slots[time(17)].booked_count == 1
+
+
+def test_upsert_is_a_noop_until_the_template_changes(ctx):
+    created = ctx.upsert_personal_slots()
+    assert created > 0
+    assert ctx.upsert_personal_slots() == 0
+    assert ctx.upsert_personal_slots(full=True) == 0
+
+
+def test_overlapping_blocks_are_rejected(ctx):
+    result = ctx.app.test_cli_runner().invoke(args=["schedule-set", "2", "09:00-12:00", "11:00-13:00"])
+    assert result.exit_code == 2
+    assert "si sovrappongono" in result.output
+    assert ctx.ScheduleBlock.query.count() == 0
+
+
+def test_coached_and_uncoached_blocks_compile(ctx):
+    blocks = [(0, time(9), time(11), "Anna", None), (0, time(11), time(12), None, None)]
+    table = ctx.compile_schedule(blocks, 60)
+    assert [(s.hour, c) for s, _, c in table[0]] == [(9, "Anna"), (10, "Anna"), (11, None)]
+    # same hour, different coach (stored before overlaps were rejected): one slot, no TypeError
+    table = ctx.compile_schedule([(0, time(9), time(10), "Anna", None), (0, time(9), time(10), None, None)], 60)
+    assert len(table[0]) == 1
+
+
+def test_each_coach_keeps_their_own_blocks(ctx):
+    runner = ctx.app.test_cli_runner()
+    assert runner.invoke(args=["schedule-set", "0"]).exit_code == 0  # Monday: no uncoached hours
+    assert runner.invoke(args=["schedule-set", "0", "08:00-10:00", "--coach", "Anna"]).exit_code == 0
+    assert runner.invoke(args=["schedule-set", "0", "14:00-16:00", "--coach", "Marco"]).exit_code == 0
+    table = ctx.compiled_schedule()
+    assert [(s.hour, c) for s, _, c in table[0]] == [(8, "Anna"), (9, "Anna"), (14, "Marco"), (15, "Marco")]
+
+    result = runner.invoke(args=["schedule-set", "0", "09:00-11:00", "--coach", "Marco"])
+    assert result.exit_code == 2
+    assert "si sovrappongono" in result.output
+    assert ctx.ScheduleBlock.query.filter_by(weekday=0, coach="Marco").count() == 1
+
+    # setting Anna again replaces only Anna's hours
+    assert runner.invoke(args=["schedule-set", "0", "10:00-12:00", "--coach", "Anna"]).exit_code == 0
+    table = ctx.compiled_schedule()
+    assert [(s.hour, c) for s, _, c in table[0]] == [(10, "Anna"), (11, "Anna"), (14, "Marco"), (15, "Marco")]
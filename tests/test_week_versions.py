@@ -0,0 +1,30 @@
+from conftest import make_class
+from querycount import count_queries
+
+
+def test_week_version_is_bumped_after_the_booking_commits(ctx):
+    cs = make_class()
+    start = ctx.week_of(cs.date)
+    before = ctx.week_stamp(start)[0]
+
+    with count_queries() as statements:
+        member, _ = ctx.find_or_create_member("Cliente", "cliente@example.com", "")
+        assert ctx.claim_spot(cs.id)
+        ctx.db.session.add(ctx.Booking(member_id=member.id, class_id=cs.id))
+        ctx.db.session.flush()
+    # nothing in the booking transaction touches the shared week_version row
+    assert not [s for s in statements if "week_version" in s]
+    ctx.db.session.commit()
+
+    assert ctx.week_stamp(start)[0] == before + 1
+
+
+def test_rolled_back_writes_do_not_bump(ctx):
+    cs = make_class()
+    start = ctx.week_of(cs.date)
+    before = ctx.week_stamp(start)[0]
+    cs.capacity = 5
+    ctx.db.session.flush()
+    ctx.db.session.rollback()
+    ctx.db.session.commit()
+    assert ctx.week_stamp(start)[0] == before
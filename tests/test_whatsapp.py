@@ -0,0 +1,43 @@
+from time import monotonic
+
+
+def test_inline_send_fails_fast_on_retry_after(ctx, graph_api):
+    graph_api.replies = [(503, {"Retry-After": "4"})] * 3
+    t0 = monotonic()
+    assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+    assert monotonic() - t0 < 1
+    assert len(graph_api.received) == 1
+    assert ctx.whatsapp_breaker.snapshot()["consecutive_failures"] == 1
+
+
+def test_breaker_opens_after_consecutive_failures(ctx, graph_api):
+    graph_api.replies = [(503, {})] * 10
+    for _ in range(3):  # the fixture's threshold
+        assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+    assert ctx.whatsapp_breaker.snapshot()["state"] == "open"
+    assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+    assert len(graph_api.received) == 3  # the open circuit made no call
+
+
+def test_client_error_does_not_count_as_outage(ctx, graph_api):
+    graph_api.replies = [(400, {})]
+    assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+    assert ctx.whatsapp_breaker.snapshot() == {"state": "closed", "consecutive_failures": 0}
+    assert ctx.send_whatsapp_text("+393330000000", "ciao") is True
+
+
+def test_send_errors_are_logged(ctx, graph_api, caplog):
+    graph_api.replies = [(500, {})]
+    assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+    assert "WhatsApp send error: 500" in caplog.text
+
+
+def test_slow_upstream_times_out_and_opens_the_breaker(ctx, graph_api, monkeypatch):
+    monkeypatch.setattr(ctx, "WHATSAPP_TIMEOUT", (1.0, 0.2))
+    graph_api.delay = 1.0
+    for _ in range(3):  # the fixture's threshold
+        t0 = monotonic()
+        assert ctx.send_whatsapp_text("+393330000000", "ciao") is False
+        assert monotonic() - t0 < 0.8  # bounded by the read timeout, not the upstream
+    assert ctx.whatsapp_breaker.snapshot()["state"] == "open"
+    assert len(graph_api.received) == 3  # a read timeout is not retried